@@ -0,0 +1,110 @@
+""" Benchmark of Ddpsolve.funcit on the water management model
+
+Compares the time and memory allocated by the iterations of
+`Ddpsolve.funcit`, which reuse the work arrays of `Ddpsolve.valmax`,
+with the previous implementation of `valmax`, which allocated several
+(n, m) temporaries per iteration. The model is `demddp05.py` with a larger
+dam capacity.
+
+The current implementation still copies ``dot(P, v)``, of shape (m, n),
+into the (n, m) array of action values. That copy does not allocate
+memory of size n * m, and it takes well under 1% of the time of the
+product. Some NumPy versions use iteration buffers for it, up to two
+buffers of 8192 values (about 128 KB) per iteration whatever the size of
+the model. Others allocate nothing. So the memory reported for the
+current implementation ranges from under 1 KB to about 129 KB.
+
+Usage: python bench_valmax.py [maxcap [maxit]]
+"""
+import sys
+sys.path.append("..")
+import time
+import tracemalloc
+
+import scipy as sp
+
+import psc585
+from psc585 import dp
+
+maxcap = int(sys.argv[1]) if len(sys.argv) > 1 else 300
+maxit = int(sys.argv[2]) if len(sys.argv) > 2 else 200
+
+## Model of demddp05.py
+alpha1, beta1 = 14, 0.8
+alpha2, beta2 = 10, 0.4
+r = sp.array([0, 1, 2, 3, 4])
+p = sp.array([0.1, 0.2, 0.4, 0.2, 0.1])
+delta = 0.9
+minlevel = 10
+
+S = sp.r_[:maxcap + 1]
+X = sp.r_[:maxcap + 1]
+n = S.shape[0]
+m = X.shape[0]
+
+f = sp.zeros((n, m))
+P = sp.zeros((m, n, n))
+for i in range(n):
+    for k in range(m):
+        if X[k] > S[i]:
+            f[i, k] = -sp.inf
+        else:
+            geq = int(S[i] - X[k] >= minlevel)
+            f[i, k] = (alpha1 * X[k] ** beta1 +
+                       alpha2 * max(0, (S[i] - X[k]) * geq) ** beta2)
+        for j in range(len(r)):
+            snext = min(max(S[i] - X[k] + r[j], 0), maxcap)
+            P[k, i, snext] += p[j]
+
+mod = dp.Ddpsolve.from_transprob(transprob=P, reward=f, discount=delta)
+
+def valmax_old(model, v):
+    """ valmax before the work arrays were added """
+    U = model.reward + sp.reshape(model.discount * sp.dot(model.P, v),
+                                  (model.m, model.n)).T
+    x = U.argmax(1)
+    v = U[sp.r_[0:model.n], x]
+    return (v, x)
+
+def step_old(v):
+    """ One iteration of funcit before the work arrays were added """
+    vold = v.copy()
+    return valmax_old(mod, vold)[0]
+
+## Arrays swapped between iterations, as in Ddpsolve.funcit
+work = [sp.empty(n), sp.empty(n, dtype=sp.intp)]
+
+def step_new(v):
+    """ One iteration of Ddpsolve.funcit """
+    vnew = work[0]
+    mod.valmax(v, out=(vnew, work[1]))
+    work[0] = v
+    return vnew
+
+def bench(step):
+    """ Wall time and peak memory allocated while iterating
+
+    The memory is the peak traced by `tracemalloc` above what is
+    allocated before the loop, i.e. the temporaries created by one
+    iteration.
+    """
+    v = step(sp.zeros(n))
+    t0 = time.time()
+    for it in range(maxit):
+        v = step(v)
+    t = time.time() - t0
+    tracemalloc.start()
+    base = tracemalloc.get_traced_memory()[0]
+    for it in range(10):
+        v = step(v)
+    peak = tracemalloc.get_traced_memory()[1] - base
+    tracemalloc.stop()
+    return v.copy(), t, peak
+
+print("n = m = %d, %d iterations" % (n, maxit))
+v0, t0, peak0 = bench(step_old)
+v1, t1, peak1 = bench(step_new)
+print("max abs difference in v: %g" % abs(v0 - v1).max())
+print("%-10s %10s %22s" % ("", "time (s)", "per iteration (KB)"))
+print("%-10s %10.3f %22.1f" % ("previous", t0, peak0 / 1024.))
+print("%-10s %10.3f %22.1f" % ("current", t1, peak1 / 1024.))
@@ -24,30 +24,19 @@ m = len(X)
 def cost(s, x):  return x**2 / (1. + s)
 
 ## Reward function
-f = sp.zeros((n, m))
-## I can use indices for states and actions
-## Since python indexes on 0
-## All states
-for i in range(n):
-    ## All actions
-    for j in range(m):
-        ## If enough ore to extract
-        if j <= i:
-            f[i, j] = price * j - cost(i, j)
-        else:
-            f[i, j] = -Inf
+def reward(s, x):
+    return price * x - cost(s, x)
+
+## If enough ore to extract
+def feasible(s, x):
+    return x <= s
 
 ## Deterministic Transition
-g = sp.zeros((n, m))
-for i in range(n):
-    for j in range(m):
-        snext = sp.nonzero(S == i - j)[0]
-        if len(snext) > 0:
-            g[i, j] = snext
-            
-
-model = dp.Ddpsolve.from_transfunc(transfunc=g, reward=f,
-                                   discount=delta)
+def transition(s, x):
+    return s - x
+
+model = dp.Ddpsolve.from_functions(S, X, reward, transition,
+                                   feasible_fn=feasible, discount=delta)
 ddp01_1 = model.funcit(sp.zeros(n))
 ddp01_2 = model.newton(sp.zeros(n), gauss_seidel=True)
 
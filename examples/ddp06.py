@@ -26,38 +26,31 @@ n = len(S)
 # Number of actions
 m = 3
 
-## Reward matrix
-f = sp.zeros((n, m))
+## Actions
+X = sp.r_[:m]
+
+## Outcomes: does not survive predation, survives and finds food,
+## survives and does not find food
+outcomes = sp.r_[:3]
+## Outcome probabilities for each action
+prob = sp.column_stack((1 - p, p * q, p * (1 - q)))[sp.newaxis, :, :]
 
-def getindex(x, A):
-    return (x == A).nonzero()[0][0]
+def transition(s, x, j):
+    snext = sp.where(j == 1, sp.minimum(s - 1 + e[x], emax), s - 1)
+    ## Death is absorbing
+    return sp.where((s == 0) | (j == 0), 0, snext)
+
+## Reward matrix
+def reward(s, x):
+    return sp.zeros((n, m))
 
-P = sp.zeros((m, n, n))
-for k in range(m):
-    P[k, 0, 0] = 1
-    for i in range(1, n):
-        ## does not survive predation
-        snext = 0
-        j = getindex(snext, S)
-        P[k, i, j] = P[k, i, j] + 1 - p[k]
-        # survives and finds food
-        snext = min(S[i] - 1 + e[k], emax)
-        j = getindex(snext, S)
-        P[k, i, j] = P[k, i, j] + p[k] * q[k]
-        # survives, does not find food
-        snext = S[i] - 1
-        j = getindex(snext, S)
-        P[k, i, j] = P[k, i, j] + p[k] * (1 - q[k])
-        
 # terminal values
 vterm = sp.ones((n, 1))
 vterm[0, 0] = 0
 
-ddp06 = dp.Ddpsolve.from_transprob(discount=1,
-                                   reward = f,
-                                   transprob=P,
-                                   T=T,
-                                   vterm=vterm)
+ddp06 = dp.Ddpsolve.from_functions(S, X, reward, transition,
+                                   shocks=(outcomes, prob), dense=True,
+                                   discount=1, T=T, vterm=vterm)
 
 x, v, pstar = ddp06.backsolve()
 
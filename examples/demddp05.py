@@ -46,31 +46,22 @@ X = sp.r_[:maxcap + 1]
 m = X.shape[0]
 
 ## Reward function
-f = sp.zeros((n, m))
-for i in range(n):
-    for k in range(m):
-        ## Action greater than possible extraction
-        if X[k] > S[i]:
-            f[i, k] = -sp.Inf
-        else:
-            geq =  int(S[i] - X[k] >= minlevel)
-            f[i, k] = F(X[k]) + G(max(0, (S[i] - X[k]) * geq))
+## Action greater than possible extraction is infeasible
+def reward(s, x):
+    geq = (s - x >= minlevel)
+    return F(x) + G(sp.maximum(0, (s - x) * geq))
 
-# transition matrix
-# Axis 0 : action
-# axis 1 : state from
-# axis 2 : state to
-P = zeros((m, n, n))
-for k in range(m):
-    for i in range(n):
-        for j in range(len(r)):
-            snext = min(S[i] - X[k] + r[j], maxcap)
-            ## Since states indexed from 0
-            ## snext is also the next index
-            P[k, i, snext] = P[k, i, snext] + p[j]
+def feasible(s, x):
+    return x <= s
 
-            
-mod = dp.Ddpsolve.from_transprob(transprob = P, reward = f, discount = delta)    
+## Transition function
+## Since states are indexed from 0, the next state is also the next index
+def transition(s, x, rain):
+    return sp.minimum(s - x + rain, maxcap)
+
+mod = dp.Ddpsolve.from_functions(S, X, reward, transition,
+                                 shocks=(r, p), feasible_fn=feasible,
+                                 discount=delta)
 res = mod.funcit()
 
 
@@ -1,7 +1,16 @@
 """Dynamic Programming"""
+import multiprocessing
+from multiprocessing import sharedctypes
+from multiprocessing.pool import ThreadPool
+
+from numpy.lib.format import open_memmap
+from numpy.random import default_rng, SeedSequence
+
 import scipy as sp
 from scipy import linalg as la
 from scipy import sparse
+from scipy.sparse import csgraph
+from scipy.sparse import linalg as spla
 
 EPS = sp.sqrt(sp.finfo(sp.float64).eps)
 
@@ -13,11 +22,200 @@ def eyeminus(x):
 def _expandg(g):
     """ Expand transition function to a matrix
     """
+    n = g.shape[0]
     P = sparse.coo_matrix((sp.ones(sp.prod(g.shape)),
                              (sp.r_[0:sp.prod(g.shape)],
-                              g.flatten(1))))
+                              g.flatten('F').astype(int))),
+                          shape=(sp.prod(g.shape), n))
     return P.tocsr()
 
+def _polop(pstar, discount):
+    """ I - discount * pstar as a LinearOperator, and a preconditioner
+
+    The preconditioner is an incomplete LU factorization if `pstar` is
+    sparse, and the diagonal (Jacobi) otherwise.
+    """
+    n = pstar.shape[0]
+    A = spla.LinearOperator((n, n), dtype=float,
+                            matvec=lambda y: y - discount * pstar.dot(y))
+    M = None
+    if sparse.issparse(pstar):
+        try:
+            ilu = spla.spilu(_polmatrix(pstar, discount))
+            M = spla.LinearOperator((n, n), matvec=ilu.solve, dtype=float)
+        except RuntimeError:
+            ## Singular incomplete factor
+            pass
+    else:
+        d = 1 - discount * pstar.diagonal()
+        M = spla.LinearOperator((n, n), matvec=lambda y: y / d, dtype=float)
+    return A, M
+
+def _krylov(method, A, b, x0, atol, M=None):
+    """ Solve A x = b to absolute residual `atol` with a Krylov method
+
+    Returns the solution and the exit status of `method`.
+    """
+    try:
+        return method(A, b, x0=x0, rtol=0., atol=atol, M=M)
+    except TypeError:
+        ## scipy < 1.12 calls rtol tol
+        return method(A, b, x0=x0, tol=0., atol=atol, M=M)
+
+class _PolicyFactor(object):
+    r""" Factorization of I - discount * pstar, updated when the policy changes
+
+    The matrix :math:`Q_0 = I - \delta P_0` of a base policy is
+    factored once. If a policy differs from the base policy in the rows
+    `R`, then :math:`Q = Q_0 + E_R D` with
+    :math:`D = -\delta (P[R] - P_0[R])`, and by the
+    Sherman-Morrison-Woodbury formula
+
+    .. math::
+        Q^{-1} b = y - Z (I + D Z)^{-1} D y
+
+    where :math:`y = Q_0^{-1} b` and :math:`Z = Q_0^{-1} E_R`.
+    """
+
+    def __init__(self, model, x):
+        self.model = model
+        self.discount = model.discount
+        self.x = sp.asarray(x, dtype=int).copy()
+        Q0 = _polmatrix(model.valpol(self.x)[0], self.discount)
+        if sparse.issparse(Q0):
+            self.lu = spla.splu(Q0)
+        else:
+            self.lu = la.lu_factor(Q0, overwrite_a=True)
+        self.rank = 0
+        self.Z = None
+
+    def _solve0(self, b):
+        """ Solve with the base matrix """
+        if isinstance(self.lu, tuple):
+            return la.lu_solve(self.lu, b)
+        return self.lu.solve(b)
+
+    def update(self, x, maxrank):
+        """ Change the policy to `x`
+
+        Returns False, without changing anything, if more than
+        `maxrank` rows differ from the base policy.
+        """
+        n = self.model.n
+        x = sp.asarray(x, dtype=int)
+        R = sp.flatnonzero(x != self.x)
+        r = len(R)
+        if r > maxrank:
+            return False
+        self.rank = r
+        if r == 0:
+            self.Z = None
+            return True
+        prows = self.model._transrows
+        D = -self.discount * (prows(x[R] * n + R) - prows(self.x[R] * n + R))
+        E = sp.zeros((n, r))
+        E[R, sp.r_[0:r]] = 1
+        self.Z = self._solve0(E)
+        self.D = D
+        self.C = la.lu_factor(sp.eye(r) + sp.asarray(D.dot(self.Z)))
+        return True
+
+    def solve(self, b):
+        """ Solve Q v = b for the current policy """
+        y = self._solve0(b)
+        if self.Z is None:
+            return y
+        return y - sp.dot(self.Z, la.lu_solve(self.C, self.D.dot(y)))
+
+def _aggregation(n, factor):
+    """ Aggregation of groups of `factor` consecutive states
+
+    Returns
+    ---------
+    R : CSR matrix, shape (nc, n)
+        Restriction. Averages the states of each group.
+    Pr : CSR matrix, shape (n, nc)
+        Prolongation. Copies the value of a group to its states.
+    """
+    group = sp.r_[0:n] // factor
+    nc = group[-1] + 1
+    size = sp.bincount(group).astype(float)
+    Pr = sparse.csr_matrix((sp.ones(n), (sp.r_[0:n], group)), shape=(n, nc))
+    R = sparse.csr_matrix((1 / size[group], (group, sp.r_[0:n])),
+                          shape=(nc, n))
+    return R, Pr
+
+def _segmax(U, ptr):
+    """ Max and argmax of consecutive segments of a vector
+
+    Parameters
+    -----------
+    U : array, shape (N, ) or (N, B)
+        Values. Each column is done separately.
+    ptr : array, shape (n + 1, )
+        Segment `i` is ``U[ptr[i]:ptr[i + 1]]``. Segments must not be
+        empty.
+
+    Returns
+    ---------
+    v : array, shape (n, ) or (n, B)
+        Maximum of each segment
+    pos : array, shape (n, ) or (n, B)
+        Index in `U` of the first maximum of each segment
+    """
+    v = sp.maximum.reduceat(U, ptr[:-1], axis=0)
+    seg = sp.repeat(sp.r_[0:len(ptr) - 1], sp.diff(ptr))
+    N = U.shape[0]
+    ## First hit in each segment
+    index = sp.r_[0:N].reshape((N, ) + (1, ) * (U.ndim - 1))
+    hit = sp.where(U >= v[seg], index, N)
+    return v, sp.minimum.reduceat(hit, ptr[:-1], axis=0)
+
+def _csrcols(A, rows):
+    """ Column indices of the entries of `rows` of a CSR matrix
+
+    Same as ``A[rows].indices``, without building the submatrix.
+    """
+    start = A.indptr[rows]
+    cnt = A.indptr[rows + 1] - start
+    return A.indices[sp.repeat(start - sp.cumsum(cnt) + cnt, cnt)
+                     + sp.arange(cnt.sum())]
+
+def _polmatrix(pstar, discount):
+    """ I - discount * pstar
+
+    Returns a CSC matrix if `pstar` is sparse, so that it can be
+    factored with `splu`.
+    """
+    if sparse.issparse(pstar):
+        n = pstar.shape[0]
+        return (sparse.eye(n, n, format='csc') - discount * pstar).tocsc()
+    Q = pstar * discount
+    eyeminus(Q)
+    return Q
+
+def _polsolve(Q, b):
+    """ Solve Q x = b with a dense or sparse LU factorization """
+    if sparse.issparse(Q):
+        return spla.splu(Q.tocsc()).solve(b)
+    return la.solve(Q, b)
+
+def _stateindex(states, values):
+    """ Index in `states` of each element of `values`
+
+    Raises ValueError if a value is not (close to) one of the states.
+    """
+    order = sp.argsort(states, kind='mergesort')
+    grid = states[order]
+    i = sp.searchsorted(grid, values).clip(1, max(len(grid) - 1, 1))
+    ## Nearest of the two neighbors
+    left = (sp.absolute(values - grid[i - 1])
+            <= sp.absolute(grid[i % len(grid)] - values))
+    i = sp.where(left, i - 1, i % len(grid))
+    if not sp.allclose(grid[i], values):
+        raise ValueError("Next states are not in the state space")
+    return order[i]
+
 class Ddpsolve(object):
     """ Discrete Time, Discrete Choice Dynamic Programming Problems
     
@@ -28,35 +226,201 @@ class Ddpsolve(object):
        or (0, 1] for finite horizon problems.
     reward: array, shape (n, m)
        Reward values
-    P: array, shape (m * n, n)
+    P: array or sparse matrix, shape (m * n, n)
        Stochastic transition matrix. The axes correspond to action,
-       initial state, and next state.
+       initial state, and next state. A dense `P` is stored C-contiguous,
+       so it is also a contiguous (m, n, n) array. If `P` is a sparse
+       matrix it is stored as CSR, and all methods keep it (and the
+       `pstar` they return) sparse.
     T: int, optional
        Number of time periods. Set to `None` for
        infinite horizon problems.
     vterm: optional
        Terminal value function for finite horizon problems.
+    g: array, shape (n, m), optional
+       Deterministic transition function. Axes are state, action, and
+       the values are the index of the next state. If given, the
+       Bellman operator gathers `v[g]` instead of computing `dot(P, v)`,
+       and `P` may be `None`.
+    workers: int, optional
+       Number of threads used by `valmax`. With more than one, the
+       states are split into blocks that are solved in a thread pool,
+       which is kept until `close` or until `workers` changes.
+    exog: array, shape (ne, ne), optional
+       Transition matrix of an exogenous Markov state that evolves
+       independently of the action. The states are the pairs
+       ``s = e * nx + z`` of an exogenous state `e` and an endogenous
+       state `z`, and `g` gives ``e * nx + z'``, where `z'` is the next
+       endogenous state. See `from_kron`.
+    compact: bool, optional
+       If True, only the feasible (state, action) pairs, those with a
+       finite reward, are stored and scored. See `pairs`.
+    pairs: tuple (ps, pa, ptr) or None
+       Feasible pairs of a compact model, sorted by state and action:
+       the states `ps`, the actions `pa`, and the offsets `ptr`, such
+       that the pairs of state `s` are ``ptr[s]:ptr[s + 1]``. The rows
+       of `P` of these pairs are kept, and `P` is set to `None`. Every
+       state must have a feasible action.
+    warm_start: bool, optional
+       If True, solvers called without `v` start from the last solution
+       of the model instead of zeros, so that repeated solves after
+       `setReward` or `setDiscount` are cheap. The number of iterations
+       and, within `tol`, the values returned then depend on earlier
+       calls. Default False.
 
     """
     
-    def __init__(self, discount, reward, P, T=None, vterm=None):
+    def __init__(self, discount, reward, P=None, T=None, vterm=None, g=None,
+                 workers=1, exog=None, compact=False, warm_start=False):
         self.discount = discount
         self.reward = reward
         self.T = T
         self.n, self.m = self.reward.shape
-        self.P = P 
+        if P is None and g is None:
+            raise ValueError("Either P or g must be given")
+        if sparse.issparse(P):
+            P = P.tocsr()
+        elif P is not None:
+            P = sp.ascontiguousarray(P, dtype=float)
+        self.P = P
+        if g is not None:
+            g = sp.asarray(g).astype(int)
+        self.g = g
+        if exog is not None:
+            exog = sp.asarray(exog, dtype=float)
+        self.exog = exog
         self.vterm = vterm
         if self.T and vterm is None:
             self.vterm = sp.zeros(self.n)
+        ## valmax work arrays
+        self._U = None
+        self._UB = None
+        self.workers = workers
+        self._pool = None
+        self.pairs = None
+        if compact:
+            self._compact()
+        ## Last solution, for warm starts
+        self.warm_start = warm_start
+        self._last = None
+        self._factor = None
+
+    def _compact(self):
+        """ Keep only the feasible (state, action) pairs """
+        ps, pa = sp.isfinite(self.reward).nonzero()
+        count = sp.bincount(ps, minlength=self.n)
+        if (count == 0).any():
+            raise ValueError("Every state must have a feasible action")
+        self.pairs = (ps, pa, sp.r_[0, sp.cumsum(count)])
+        ## Keys of the pairs, to find the pair of a row of P
+        self._keys = ps * self.m + pa
+        self._pf = self.reward[ps, pa]
+        if self.g is not None:
+            self._Pp = self.g[ps, pa]
+        else:
+            self._Pp = self.P[pa * self.n + ps, ]
+            self.P = None
+
+    def __getstate__(self):
+        """ Pickle without the work arrays and the thread pool """
+        state = self.__dict__.copy()
+        state['_U'] = None
+        state['_UB'] = None
+        state['_pool'] = None
+        state['_factor'] = None
+        state.pop('_EV', None)
+        return state
 
     def setReward(self, reward):
-        """Set reward"""
+        """Set reward
+
+        In a compact model the feasible pairs do not change, and only
+        their rewards are used.
+        """
         self.reward = reward
         self.n, self.m = self.reward.shape
+        self._U = None
+        if self.pairs is not None:
+            self._pf = self.reward[self.pairs[0], self.pairs[1]]
 
-    def valmax(self, v):
+    def setDiscount(self, discount):
+        """Set discount factor
+
+        The last solution is kept as starting values, but not the
+        factorization of its policy.
+        """
+        self.discount = discount
+        self._factor = None
+
+    def _solved(self, res, factor=None):
+        """ Keep the values and policy of the solver result `res`,
+        and the factorization of the policy if given. Returns `res`. """
+        self._last = (sp.array(res[3], dtype=float), sp.array(res[4]))
+        if factor is not None:
+            self._factor = factor
+        return res
+
+    def _warmstart(self, v, policy=False):
+        """ Starting values of a solver
+
+        `v` if given. Otherwise the last solution, or None. If the
+        policy of the last solution was factored, with the same
+        discount, it is evaluated with the current rewards, so that a
+        solver stops after one step if the policy is still optimal.
+
+        With `policy`, returns ``(v, x)``, where `x` is the policy of
+        the last solution if `v` is its evaluation, and None otherwise.
+        """
+        x = None
+        if v is None and self.warm_start and self._last is not None:
+            v, xlast = self._last
+            v = v.copy()
+            factor = self._factor
+            if factor is not None and factor.discount == self.discount \
+                    and factor.update(xlast, 0):
+                v = factor.solve(self.valpol(xlast)[1])
+                x = xlast.copy()
+        if policy:
+            return (v, x)
+        return v
+
+    def _expectv(self, v):
+        """ Values gathered by `g`
+
+        `v` itself, or, if `exog` is given, the expected values over the
+        next exogenous state, ``E[v(e', z) | e]``, flattened like `v`.
+        """
+        if self.exog is None:
+            return v
+        ne = self.exog.shape[0]
+        return sp.dot(self.exog, v.reshape((ne, -1))).ravel()
+
+    def _workspace(self):
+        """ Work arrays for valmax
+
+        Allocates, once, the (n, m) array of action values and the
+        (m, n) array of expected values, or, in a compact model, the
+        array of values of the feasible pairs.
+        """
+        if self._U is None and self.pairs is not None:
+            self._U = sp.empty(len(self._pf))
+        elif self._U is None:
+            self._U = sp.empty((self.n, self.m))
+            self._EV = sp.empty((self.m, self.n))
+        return self._U
+
+    def valmax(self, v, out=None):
         """ Solve single Bellman equation
 
+        Parameters
+        ----------------
+        v : array (n, )
+            Values
+        out : tuple of arrays, optional
+            Arrays ``(v, x)`` of shape (n, ) and types float and intp
+            in which to write the results. Otherwise new arrays are
+            returned.
+
         Returns
         ----------------
         v : array (n, )
@@ -74,15 +438,266 @@ class Ddpsolve(object):
             \left\{
                 f(s, x) + \delta \sum_{s' \in S} P(s' | s, x) V(s')
              \right\}            
+
+        The action values are computed in work arrays stored on the
+        instance, so that repeated calls (as in `funcit`) do not
+        allocate temporaries of size n * m.
+
+        If `workers` is greater than one, blocks of states are solved
+        in a thread pool (NumPy releases the GIL in these operations).
+
+        In a compact model, only the feasible pairs are scored, and the
+        max and argmax are taken over the segment of pairs of each
+        state. `workers` is then ignored.
         """
-        U = self.reward + sp.reshape(self.discount * sp.dot(self.P, v),
-                                     (self.m, self.n)).T
+        v = sp.asarray(v, dtype=float)
+        if out is None:
+            out = (sp.empty(self.n), sp.empty(self.n, dtype=sp.intp))
+        if self.workers > 1 and self.pairs is None:
+            self._workspace()
+            return self._valmax_threaded(v, out)
+        U = self._qvalues(v)
+        v, x = out
+        if self.pairs is not None:
+            vmax, pos = _segmax(U, self.pairs[2])
+            v[...] = vmax
+            x[...] = self.pairs[1][pos]
+            return (v, x)
         ## argmax by row
-        x = U.argmax(1)
+        U.argmax(1, out=x)
         ## max by row
-        v = U[sp.r_[0:self.n], x]
+        U.max(1, out=v)
         return (v, x)
 
+    def _qvalues(self, v):
+        """ Action values ``f + discount * E[v]`` in the work array
+
+        Shape (n, m), or, in a compact model, one value for each
+        feasible pair.
+        """
+        U = self._workspace()
+        if self.pairs is not None:
+            if self.g is not None:
+                sp.take(self._expectv(v), self._Pp, out=U)
+            elif sparse.issparse(self._Pp):
+                U[...] = self._Pp.dot(v)
+            else:
+                sp.dot(self._Pp, v, out=U)
+            U *= self.discount
+            U += self._pf
+            return U
+        if self.g is not None:
+            sp.take(self._expectv(v), self.g, out=U)
+        else:
+            EV = self._EV
+            if sparse.issparse(self.P):
+                EV[...] = self.P.dot(v).reshape((self.m, self.n))
+            else:
+                sp.dot(self.P, v, out=EV.reshape(-1))
+            ## Transposed copy. It allocates nothing of size n * m, but
+            ## some NumPy versions use fixed-size iteration buffers
+            U[...] = EV.T
+        U *= self.discount
+        U += self.reward
+        return U
+
+    def logitmax(self, v, scale=1.):
+        r""" Smoothed Bellman equation with extreme value shocks
+
+        Parameters
+        ----------------
+        v : array (n, )
+            Values
+        scale : float, optional
+            Scale of the shocks.
+
+        Returns
+        ----------------
+        v : array (n, )
+            Expected values
+        ccp : array (n, m)
+            Conditional choice probabilities. Zero for infeasible
+            actions.
+
+        Notes
+        ------
+
+        With an i.i.d. type I extreme value shock of scale
+        :math:`\sigma` added to the reward of each action,
+
+        .. math::
+            V(s) = \sigma \left(\gamma + \log \sum_{x \in X(s)}
+            \exp(u(s, x) / \sigma) \right),
+            \quad
+            u(s, x) = f(s, x) + \delta \sum_{s' \in S} P(s' | s, x) V(s')
+
+        where :math:`\gamma` is Euler's constant, the mean of the shock,
+        and the choice probabilities are the logit probabilities of `u`.
+        The maximum over actions is subtracted before taking
+        exponentials, so that large values do not overflow.
+        """
+        v = sp.asarray(v, dtype=float)
+        U = self._qvalues(v)
+        ccp = sp.zeros((self.n, self.m))
+        if self.pairs is not None:
+            ps, pa, ptr = self.pairs
+            umax = sp.maximum.reduceat(U, ptr[:-1])
+            Z = sp.exp((U - umax[ps]) / scale)
+            total = sp.add.reduceat(Z, ptr[:-1])
+            ccp[ps, pa] = Z / total[ps]
+        else:
+            umax = U.max(1)
+            Z = sp.exp((U - umax[:, sp.newaxis]) / scale)
+            total = Z.sum(1)
+            ccp[...] = Z / total[:, sp.newaxis]
+        v = umax + scale * (sp.log(total) + sp.euler_gamma)
+        return (v, ccp)
+
+    def _valmax_threaded(self, v, out):
+        """ valmax over blocks of states in a thread pool """
+        U, EV = self._U, self._EV
+        vout, xout = out
+        pool = self._threadpool()
+        ## One product for all the states. BLAS threads a dense product
+        ## itself, so calling it from each worker would oversubscribe
+        ## the cores.
+        if self.g is not None:
+            v = self._expectv(v)
+        elif sparse.issparse(self.P):
+            EV[...] = self.P.dot(v).reshape((self.m, self.n))
+        else:
+            sp.dot(self.P, v, out=EV.reshape(-1))
+
+        def block(bounds):
+            lo, hi = bounds
+            if self.g is not None:
+                sp.take(v, self.g[lo:hi], out=U[lo:hi])
+            else:
+                U[lo:hi] = EV[:, lo:hi].T
+            U[lo:hi] *= self.discount
+            U[lo:hi] += self.reward[lo:hi]
+            U[lo:hi].argmax(1, out=xout[lo:hi])
+            U[lo:hi].max(1, out=vout[lo:hi])
+
+        cuts = sp.linspace(0, self.n, self.workers + 1).astype(int)
+        pool.map(block, zip(cuts[:-1], cuts[1:]))
+        return (vout, xout)
+
+    def _threadpool(self):
+        """ Thread pool of `valmax`, replacing one of another size """
+        if self._pool is not None and self._pool[0] != self.workers:
+            self.close()
+        if self._pool is None:
+            self._pool = (self.workers, ThreadPool(self.workers))
+        return self._pool[1]
+
+    def close(self):
+        """ Stop the threads of `valmax`, if any
+
+        They are started again if `valmax` is called with `workers`
+        greater than one.
+        """
+        if self._pool is not None:
+            pool = self._pool[1]
+            self._pool = None
+            pool.close()
+            pool.join()
+
+    def __del__(self):
+        if getattr(self, '_pool', None) is not None:
+            self.close()
+
+    def _backup(self, v, states):
+        """ Action values of `states`, shape (len(states), m) """
+        states = sp.asarray(states, dtype=int)
+        if self.g is not None:
+            EV = self._expectv(v)[self.g[states]]
+        elif self.P is None or sparse.issparse(self.P):
+            rows = (sp.r_[0:self.m][sp.newaxis, :] * self.n
+                    + states[:, sp.newaxis]).ravel()
+            EV = self._transrows(rows).dot(v).reshape((len(states), self.m))
+        else:
+            P3 = self.P.reshape((self.m, self.n, self.n))
+            EV = sp.dot(P3[:, states, :], v).T
+        return self.reward[states] + self.discount * EV
+
+    def _selfprob(self, states):
+        """ Probabilities of staying in `states`, P(s | s, a), shape
+        (len(states), m) """
+        states = sp.asarray(states, dtype=int)
+        if self.g is not None and self.exog is None:
+            return (self.g[states] == states[:, sp.newaxis]).astype(float)
+        rows = (sp.r_[0:self.m][:, sp.newaxis] * self.n + states).ravel()
+        cols = sp.tile(states, self.m)
+        if self._isdense() and self.pairs is None:
+            p = self.P[rows, cols]
+        else:
+            p = self._transrows(rows)[sp.r_[0:len(rows)], cols]
+        return sp.asarray(p).reshape((self.m, len(states))).T
+
+    def _union_graph(self):
+        """ Transitions possible under any action, as an (n, n) CSR matrix
+        of ones """
+        P = self.P
+        if self.g is not None and self.exog is None:
+            ## One next state for each pair, read from g
+            A = sparse.csr_matrix((sp.ones(self.g.size), self.g.ravel(),
+                                   sp.r_[0:self.g.size + 1:self.m]),
+                                  shape=(self.n, self.n))
+            A.sum_duplicates()
+            A.data[:] = 1
+            return A
+        if self.pairs is not None and self.g is None:
+            P = sparse.coo_matrix(self._Pp)
+            src = self.pairs[0][P.row]
+        else:
+            if P is None:
+                P = self._transrows(sp.r_[0:self.n * self.m])
+            P = sparse.coo_matrix(P)
+            src = P.row % self.n
+        keep = P.data != 0
+        A = sparse.coo_matrix((sp.ones(keep.sum()),
+                               (src[keep], P.col[keep])),
+                              shape=(self.n, self.n)).tocsr()
+        A.data[:] = 1
+        return A
+
+    def _scclevels(self):
+        """ Strongly connected components of the union graph, by level
+
+        Returns
+        --------
+        labels : array, shape (n, )
+            Component of each state.
+        level : array, shape (ncomp, )
+            Level of each component in the graph of the components: 0
+            if it has no successors, otherwise one more than the
+            highest level of its successors.
+        """
+        A = self._union_graph()
+        ncomp, labels = csgraph.connected_components(A, directed=True,
+                                                     connection='strong')
+        ## Edges between components, as predecessor lists
+        A = A.tocoo()
+        cross = labels[A.row] != labels[A.col]
+        Cpred = sparse.coo_matrix((sp.ones(cross.sum()),
+                                   (labels[A.col[cross]],
+                                    labels[A.row[cross]])),
+                                  shape=(ncomp, ncomp)).tocsr()
+        Cpred.sum_duplicates()
+        nsucc = sp.bincount(Cpred.indices, minlength=ncomp)
+        level = sp.zeros(ncomp, dtype=int)
+        ready = sp.flatnonzero(nsucc == 0)
+        l = 0
+        while len(ready):
+            level[ready] = l
+            l += 1
+            ## Predecessors of the components of this level
+            p = _csrcols(Cpred, ready)
+            sp.subtract.at(nsucc, p, 1)
+            ready = sp.unique(p[nsucc[p] == 0])
+        return labels, level
+
     def valpol(self, x):
         """ Evaluation policy
 
@@ -93,7 +708,7 @@ class Ddpsolve(object):
 
         Returns
         --------
-        pstar : array, shape (n, n)
+        pstar : array or CSR matrix, shape (n, n)
             Transition probability matrix
         fstar : array, shape (n, )
             Optimal rewards
@@ -105,30 +720,121 @@ class Ddpsolve(object):
 
         `x` is (n, T+1) for finite horizon problems, and (n, 1) for infinite
         horizon problems.
+
+        If the model has a deterministic transition function and no `P`,
+        `pstar` is built directly from `g` as a CSR matrix.
         """
         ## Select indices of policy from reward function
         ## Not sure if this works with
         ## ddpsolve.m calculates the index value
         ind = self.n * x + sp.r_[:self.n]
         fstar = self.reward[ sp.r_[0:self.n] , x.astype(int)].copy()
-        pstar = self.P[ind, ].copy()
+        pstar = self._transrows(ind.astype(int))
         return pstar, fstar, ind
 
-    def backsolve(self, T=None, vterm=None):
+    def ccppol(self, ccp):
+        r""" Transition matrix of choice probabilities `ccp`
+
+        Parameters
+        ----------------
+        ccp : array (n, m)
+            Probability of each action in each state.
+
+        Returns
+        ----------------
+        pstar : array or sparse matrix, shape (n, n)
+            Transition matrix, :math:`\sum_x ccp(s, x) P(s' | s, x)`.
+        """
+        n = self.n
+        if self._isdense() and self.pairs is None:
+            P3 = self.P.reshape((self.m, n, n))
+            return sp.einsum('sa,asj->sj', ccp, P3)
+        pstar = None
+        for a in sp.flatnonzero(ccp.any(0)):
+            Pa = self._transrows(a * n + sp.r_[0:n])
+            Pa = sparse.diags(ccp[:, a]).dot(Pa)
+            pstar = Pa if pstar is None else pstar + Pa
+        if sparse.issparse(pstar):
+            pstar = pstar.tocsr()
+        return pstar
+
+    def _isdense(self):
+        """ Whether the rows of P are stored as a dense array """
+        P = self.P
+        if self.pairs is not None and self.g is None:
+            P = self._Pp
+        return P is not None and not sparse.issparse(P)
+
+    def _transrows(self, ind):
+        """ Rows `ind` of P
+
+        Built from `g` as a CSR matrix if `P` is not stored. In a
+        compact model, the rows of infeasible pairs are zero.
+        """
+        if self.pairs is not None and self.g is None:
+            key = (ind % self.n) * self.m + ind // self.n
+            j = sp.searchsorted(self._keys, key).clip(0, len(self._keys) - 1)
+            ok = self._keys[j] == key
+            rows = self._Pp[j, ]
+            if sparse.issparse(rows):
+                return sparse.diags(sp.atleast_1d(ok).astype(float)).dot(
+                    rows).tocsr()
+            rows[~ok] = 0
+            return rows
+        if self.P is None:
+            k = len(ind)
+            gind = self.g[ind % self.n, ind // self.n]
+            if self.exog is None:
+                return sparse.csr_matrix((sp.ones(k), gind, sp.r_[0:k + 1]),
+                                         shape=(k, self.n))
+            ## One entry for each next exogenous state
+            ne = self.exog.shape[0]
+            nx = self.n // ne
+            cols = gind[:, sp.newaxis] % nx + nx * sp.r_[0:ne]
+            rows = sparse.csr_matrix((self.exog[gind // nx].ravel(),
+                                      cols.ravel(), sp.r_[0:k * ne + 1:ne]),
+                                     shape=(k, self.n))
+            rows.eliminate_zeros()
+            return rows
+        return self.P[ind, ].copy()
+
+    def backsolve(self, T=None, vterm=None, store='array', filename=None):
         """Solve finite system by backward recursion
 
         Parameters
         -------------
         T : int, optional
             Number of periods of time.
+        vterm : array, shape (n, ) or (n, B), optional
+            Terminal values. Defaults to the `vterm` of the model. With
+            B > 1 columns, each column is a scenario, and all are solved
+            together.
+        store : {'array', 'lazy', 'memmap', None}, optional
+            How to return `pstar`. 'array' builds all `T` matrices.
+            'lazy' only keeps the policy, and returns a
+            `PolicyTransitions` that builds ``pstar[..., t]`` when
+            indexed. 'memmap' writes `pstar` to the ``.npy`` file
+            `filename`. None does not return `pstar`.
+        filename : str, optional
+            File for `store` = 'memmap'.
 
         Returns
         ----------
-        X : array, shape (n, T)
+        X : array, shape (n, T) or (n, T, B)
             Optimal controls. An optimal policy for each starting state
-        V : array, shape (n, T + 1)
+        V : array, shape (n, T + 1) or (n, T + 1, B)
             Value function.             
+        pstar : array, shape (n, n, T), list, PolicyTransitions, or None
+            Optimal transition matrices. If `store` is 'array' and `P`
+            is sparse, a list of `T` CSR matrices. With B scenarios, a
+            list of the `pstar` of each scenario.
+
+        Notes
+        -------
 
+        With B scenarios, each period is one batched Bellman step on the
+        (n, B) values, with a single product ``dot(P, V)``, as in
+        `funcit_batch`. 'memmap' only stores one scenario.
         """
         if T is None:
             if self.T is not None:
@@ -136,31 +842,85 @@ class Ddpsolve(object):
             else:
                 print ("Not a finite time model")
                 return
-        if vterm is None and self.vterm is None:
-            vterm = sp.zeros(self.n)
-        else:
+        if vterm is None:
             vterm = self.vterm
-        x = sp.zeros((self.n, T), dtype=int)
-        v = sp.column_stack((sp.zeros((self.n, T)), vterm))
-        pstar = sp.zeros((self.n, self.n, T))
+        if vterm is None:
+            vterm = sp.zeros(self.n)
+        vterm = sp.asarray(vterm, dtype=float).reshape((self.n, -1))
+        B = vterm.shape[1]
+        if B > 1 and store == 'memmap':
+            raise ValueError("store='memmap' only takes one terminal value")
+        x = sp.zeros((self.n, T, B), dtype=int)
+        v = sp.zeros((self.n, T + 1, B))
+        v[:, T] = vterm
+        if B > 1:
+            R = self._batchrewards(self.reward[sp.newaxis])
         for t in sp.arange(T - 1, -1, -1):
-            v[ :, t] , x[ :, t]  = self.valmax(v[ : , t + 1])
-            pstar[..., t] = self.valpol(x[:, t])[0]
+            if B > 1:
+                v[:, t], x[:, t] = self._valmax_batch(v[:, t + 1], R)
+            else:
+                v[:, t, 0], x[:, t, 0] = self.valmax(v[:, t + 1, 0])
+        if B > 1:
+            pstar = None
+            if store is not None:
+                pstar = [self._backpstar(x[..., b], store, filename)
+                         for b in range(B)]
+            return (x, v, pstar)
+        x = x[..., 0]
+        v = v[..., 0]
+        pstar = None
+        if store is not None:
+            pstar = self._backpstar(x, store, filename)
         return (x, v, pstar)
 
-    def funcit(self, v=None, maxit=100, tol=EPS, error_bounds=True):
+    def _backpstar(self, x, store, filename):
+        """ Transition matrices of the policy `x`, shape (n, T), of
+        `backsolve` """
+        T = x.shape[1]
+        ## pstar is sparse when P is sparse or not built
+        issparse = not self._isdense()
+        if store == 'lazy':
+            return PolicyTransitions(self, x)
+        if store == 'memmap':
+            pstar = open_memmap(filename, mode='w+', dtype=float,
+                                shape=(self.n, self.n, T))
+        elif issparse:
+            pstar = [None] * T
+        else:
+            pstar = sp.zeros((self.n, self.n, T))
+        for t in range(T):
+            pt = self.valpol(x[:, t])[0]
+            if store == 'memmap' and issparse:
+                pstar[..., t] = pt.toarray()
+            elif issparse and store != 'memmap':
+                pstar[t] = pt
+            else:
+                pstar[..., t] = pt
+        if store == 'memmap':
+            pstar.flush()
+        return pstar
+
+    def funcit(self, v=None, maxit=100, tol=EPS, error_bounds=True,
+               eliminate=False, anderson=0):
         """ Solve Bellman equations by function iteration
 
         Parameters
         --------------
         v : array, shape (n, ), optional
-           Initial guess
+           Initial guess. By default zeros or, with `warm_start`, the
+           last solution.
         maxit : int, optional
            Maximum number of iterations
         tol : float, optional
            Convergence tolerance
         error_bounds : bool, optional
            Use error bounds to determine convergence.
+        eliminate : bool, optional
+           Use the error bounds to eliminate suboptimal actions. Implies
+           `error_bounds`.
+        anderson : int, optional
+           If positive, use Anderson acceleration with this many past
+           iterates. Implies `error_bounds`.
 
         Returns
         ------------
@@ -174,41 +934,330 @@ class Ddpsolve(object):
         x : array, shape 
         pstar : array, shape
            
+        Notes
+        --------
+
+        With `eliminate`, after each iteration action `x` is dropped in
+        state `s` if
+
+        .. math::
+            v_t(s) - U_t(s, x) > u_t - l_t
+
+        where :math:`U_t` are the action values of the iteration and
+        :math:`l_t, u_t` the lower and upper error bounds. The left hand
+        side bounds the value of the action from above, and the right
+        hand side the optimal value from below, so the action is not
+        optimal (MacQueen 1967). Once enough actions are dropped, later
+        iterations only compute the values of the remaining (state,
+        action) pairs.
+
+        With `anderson` = k, the next iterate is the combination of the
+        last k + 1 Bellman updates :math:`T v_i` whose residuals
+        :math:`T v_i - v_i` have the least squares smallest combination.
+        If the span of the residual increases after an accelerated
+        step, the accelerated point is rejected: the history is dropped
+        and the next iterate is the plain Bellman step of the last
+        accepted one. The history is also dropped when the policy
+        changes, so that it only mixes steps of one policy.
+        The error bounds hold for any `v`, so the stopping rule is
+        unchanged.
+
         """
+        v = self._warmstart(v)
         if v is None:
             v = sp.zeros(self.n)
+        if eliminate:
+            return self._solved(self._funcit_eliminate(v, maxit, tol))
+        if anderson:
+            return self._solved(self._funcit_anderson(v, maxit, tol,
+                                                      anderson))
         info = -1
         delta = (self.discount) / (1 - self.discount)
         t = 0
         relres = tol + 1
+        ## Swap between two value arrays instead of allocating new ones
+        v = sp.array(v, dtype=float)
+        vold = sp.empty(self.n)
+        dv = sp.empty(self.n)
+        x = sp.empty(self.n, dtype=sp.intp)
         for it in range(maxit):
             t += 1
-            vold = v.copy()
-            v, x = self.valmax(vold)
+            v, vold = vold, v
+            self.valmax(vold, out=(v, x))
+            sp.subtract(v, vold, out=dv)
             if error_bounds:
-                lbound = delta * (v - vold).min()
-                ubound = delta * (v - vold).max()
+                lbound = delta * dv.min()
+                ubound = delta * dv.max()
                 relres = (ubound - lbound)
                 if relres < tol:
                     v += (ubound + lbound) / 2
                     info = 0
                     break
             else:
-                relres = la.norm(v - vold)
+                relres = la.norm(dv)
                 if relres < tol:
                     info = 0
                     break
         pstar = self.valpol(x)[0]
+        return self._solved((info, t, relres, v, x, pstar))
+
+    def _funcit_eliminate(self, v, maxit, tol):
+        """ Function iteration with action elimination
+
+        The remaining actions are kept as (state, action) pairs sorted
+        by state, with the pairs of state `s` in ``ptr[s]:ptr[s + 1]``.
+        Until half of the pairs are dropped, the full `valmax` is used.
+        """
+        info = -1
+        delta = (self.discount) / (1 - self.discount)
+        t = 0
+        relres = tol + 1
+        v = sp.array(v, dtype=float)
+        x = sp.empty(self.n, dtype=sp.intp)
+        npairs = self.n * self.m
+        pairs = None
+        if self.pairs is not None:
+            ps, pa, ptr = self.pairs
+            pairs = (ps, pa, ptr, self._pf, self._Pp)
+            npairs = len(ps)
+        for it in range(maxit):
+            t += 1
+            vold = v
+            if pairs is None:
+                v = sp.empty(self.n)
+                self.valmax(vold, out=(v, x))
+                U = self._U
+            else:
+                ps, pa, ptr, f, Pp = pairs
+                if self.g is not None:
+                    U = f + self.discount * self._expectv(vold)[Pp]
+                else:
+                    U = f + self.discount * Pp.dot(vold)
+                v, pos = _segmax(U, ptr)
+                x = pa[pos]
+            lbound = delta * (v - vold).min()
+            ubound = delta * (v - vold).max()
+            relres = (ubound - lbound)
+            if relres < tol:
+                v += (ubound + lbound) / 2
+                info = 0
+                break
+            ## Eliminate actions
+            if pairs is None:
+                keep = (v[:, sp.newaxis] - U) <= relres
+                nkeep = keep.sum()
+                if nkeep <= npairs // 2:
+                    ps, pa = keep.nonzero()
+                    ptr = sp.r_[0, sp.cumsum(keep.sum(1))]
+                    f = self.reward[ps, pa]
+                    if self.g is not None:
+                        Pp = self.g[ps, pa]
+                    else:
+                        Pp = self.P[pa * self.n + ps, ]
+                    pairs = (ps, pa, ptr, f, Pp)
+                    npairs = nkeep
+            else:
+                keep = (v[ps] - U) <= relres
+                nkeep = keep.sum()
+                if nkeep <= npairs // 2:
+                    ptr = sp.r_[0, sp.cumsum(sp.bincount(ps[keep],
+                                                         minlength=self.n))]
+                    pairs = (ps[keep], pa[keep], ptr, f[keep], Pp[keep, ])
+                    npairs = nkeep
+        pstar = self.valpol(x)[0]
+        return (info, t, relres, v, x, pstar)
+
+    def _funcit_anderson(self, v, maxit, tol, depth):
+        """ Function iteration with Anderson acceleration """
+        info = -1
+        delta = (self.discount) / (1 - self.discount)
+        t = 0
+        relres = tol + 1
+        v = sp.array(v, dtype=float)
+        G = []
+        F = []
+        accelerated = False
+        resold = sp.inf
+        for it in range(maxit):
+            t += 1
+            Tv, x = self.valmax(v)
+            f = Tv - v
+            lbound = delta * f.min()
+            ubound = delta * f.max()
+            relres = (ubound - lbound)
+            if relres < tol:
+                v = Tv + (ubound + lbound) / 2
+                info = 0
+                break
+            if accelerated and relres > resold:
+                ## Safeguard: reject the accelerated point, and restart
+                ## from the plain step of the last accepted iterate
+                G = []
+                F = []
+                v = Tvold
+                accelerated = False
+                continue
+            if t > 1 and not sp.all(x == xold):
+                ## The policy changed: the residuals of earlier
+                ## iterates belong to another linear map
+                G = []
+                F = []
+            xold = x
+            Tvold = Tv
+            G.append(Tv)
+            F.append(f)
+            if len(F) > depth + 1:
+                G.pop(0)
+                F.pop(0)
+            if len(F) > 1:
+                dF = sp.diff(sp.column_stack(F), axis=1)
+                dG = sp.diff(sp.column_stack(G), axis=1)
+                ## Constant residuals do not matter for the error bounds
+                gamma = la.lstsq(dF - dF.mean(0), f - f.mean())[0]
+                v = Tv - sp.dot(dG, gamma)
+                accelerated = True
+            else:
+                v = Tv
+                accelerated = False
+            resold = relres
+        pstar = self.valpol(x)[0]
         return (info, t, relres, v, x, pstar)
 
+    def _batchrewards(self, rewards):
+        """ Rewards of shape (B, n, m) in the layout of `_valmax_batch`
+
+        (m, n, B), or (K, B) for the K feasible pairs of a compact model.
+        """
+        if self.pairs is not None:
+            ps, pa = self.pairs[:2]
+            return rewards[:, ps, pa].T.copy()
+        return sp.ascontiguousarray(rewards.transpose((2, 1, 0)))
+
+    def _valmax_batch(self, V, R):
+        """ valmax for each column of `V`, shape (n, B)
+
+        `R` are the rewards from `_batchrewards`, with B columns or one
+        column shared by all. Returns the values and controls, both of
+        shape (n, B).
+        """
+        n, m = self.n, self.m
+        if self.g is not None:
+            W = V
+            if self.exog is not None:
+                ne = self.exog.shape[0]
+                W = sp.dot(self.exog, V.reshape((ne, -1))).reshape(V.shape)
+        if self.pairs is not None:
+            if self.g is not None:
+                U = W[self._Pp]
+            else:
+                U = sp.asarray(self._Pp.dot(V))
+            U *= self.discount
+            U += R
+            Vnew, pos = _segmax(U, self.pairs[2])
+            return Vnew, self.pairs[1][pos]
+        b = V.shape[1]
+        if self.g is not None:
+            U = W[self.g.T]
+        elif sparse.issparse(self.P):
+            ## Keeping the last array until the next one is allocated
+            ## avoids mapping fresh memory at each iteration
+            U = self._UB = self.P.dot(V).reshape((m, n, b))
+        else:
+            ## Work array, reused while the number of columns is unchanged
+            U = self._UB
+            if U is None or U.shape != (m, n, b):
+                U = self._UB = sp.empty((m, n, b))
+            sp.dot(self.P, V, out=U.reshape((m * n, b)))
+        U *= self.discount
+        U += R
+        return U.max(0), U.argmax(0)
+
+    def funcit_batch(self, rewards, v=None, maxit=100, tol=EPS):
+        """ Solve many reward matrices at once by function iteration
+
+        Parameters
+        --------------
+        rewards : array, shape (B, n, m)
+           Reward of each problem. All share `P` and `discount`.
+        v : array, shape (n, B), optional
+           Initial guess
+        maxit : int, optional
+           Maximum number of iterations
+        tol : float, optional
+           Convergence tolerance
+
+        Returns
+        ------------
+        info : array, shape (B, )
+            Exit status of each problem. 0 if converged. -1 if not.
+        t : array, shape (B, )
+            Number of iterations
+        relres : array, shape (B, )
+            Span of the error bounds
+        v : array, shape (n, B)
+        x : array, shape (n, B)
+
+        Notes
+        --------
+
+        The values of the B problems are the columns of an (n, B)
+        array `V`, so each iteration takes expectations with one
+        matrix product ``dot(P, V)`` instead of B products with
+        vectors. Convergence is checked for each column with the error
+        bounds of `funcit`, and converged columns are removed from `V`,
+        so later iterations only work on the remaining problems.
+        Rewards are kept as an (m, n, B) array, or (K, B) for the K
+        feasible pairs of a compact model.
+        """
+        rewards = sp.asarray(rewards, dtype=float)
+        B = rewards.shape[0]
+        n = self.n
+        R = self._batchrewards(rewards)
+        info = -sp.ones(B, dtype=int)
+        t = sp.zeros(B, dtype=int)
+        relres = sp.zeros(B)
+        vout = sp.zeros((n, B))
+        xout = sp.zeros((n, B), dtype=int)
+        if v is None:
+            v = sp.zeros((n, B))
+        V = sp.array(v, dtype=float).reshape((n, B))
+        delta = (self.discount) / (1 - self.discount)
+        active = sp.r_[0:B]
+        for it in range(maxit):
+            Vnew, X = self._valmax_batch(V, R)
+            t[active] += 1
+            dv = Vnew - V
+            lbound = delta * dv.min(0)
+            ubound = delta * dv.max(0)
+            relres[active] = ubound - lbound
+            V = Vnew
+            done = relres[active] < tol
+            if done.any() or it == maxit - 1:
+                ## Store all the columns in the last iteration
+                if it == maxit - 1:
+                    done[:] = True
+                cols = active[done]
+                vout[:, cols] = V[:, done]
+                xout[:, cols] = X[:, done]
+                conv = (relres[cols] < tol)
+                vout[:, cols[conv]] += (ubound + lbound)[done][conv] / 2
+                info[cols[conv]] = 0
+                active = active[~done]
+                V = sp.ascontiguousarray(V[:, ~done])
+                R = sp.ascontiguousarray(R[..., ~done])
+            if not len(active):
+                break
+        return (info, t, relres, vout, xout)
+
     def newton(self, v=None, maxit=100, tol=EPS, verbose=False,
-               gauss_seidel=False):
-        """Solve Bellman equations via Newton method (policy iteration)
+               gauss_seidel=False, solver='direct', forcing=0.1, maxrank=0):
+        r"""Solve Bellman equations via Newton method (policy iteration)
 
         Parameters
         --------------
         v : array, shape (n, ), optional
-           Initial guess for values.
+           Initial guess for values. By default zeros or, with
+           `warm_start`, the last solution.
         x : array, shape (n, ), optional
            Initial guess for policy.
         maxit : int, optional
@@ -217,6 +1266,18 @@ class Ddpsolve(object):
            Convergence tolerance
         gauss_seidel : bool, optional
            Use Gauss-Seidel to solve the linear equation.
+        solver : {'direct', 'gmres', 'bicgstab'}, optional
+           Method used to evaluate each policy. 'gmres' and 'bicgstab'
+           are preconditioned Krylov methods, which only use products
+           with `pstar`.
+        forcing : float, optional
+           With a Krylov `solver`, each policy is evaluated to an
+           absolute residual of `forcing` times the current Newton
+           residual, or `tol` if larger.
+        maxrank : int, optional
+           With the direct `solver`, keep the factorization of an
+           earlier policy as long as at most `maxrank` states have
+           changed action since, and correct it with a low rank update.
 
         Returns
         ------------
@@ -235,68 +1296,1054 @@ class Ddpsolve(object):
 
         Also called policy iteration.
 
+        If `P` is sparse or not built, the policy is evaluated with a
+        sparse LU factorization (`scipy.sparse.linalg.splu`).
+
+        With a Krylov `solver`, the linear system
+        :math:`(I - \delta P^*) v = f^*` is solved iteratively, starting
+        from the last values, and preconditioned with an incomplete LU
+        factorization (sparse `pstar`) or its diagonal (dense `pstar`).
+        The tolerance shrinks with the Newton residual
+        :math:`\|T v - v\|` (an inexact Newton method), so early
+        policies are evaluated cheaply. Once the policy is unchanged it
+        is evaluated to `tol`, and the iteration stops when the greedy
+        policy of these values is the same policy, as long as the
+        Krylov method converged.
+
+        With `maxrank`, when r states change action relative to the
+        last factored policy, the factorization is updated with the
+        Sherman-Morrison-Woodbury formula at a cost of O(n^2 r) instead
+        of refactoring in O(n^3).
+
+        The factorization of the last policy is kept on the model. With
+        `warm_start`, after `setReward`, a call without `v` evaluates the
+        last policy with it and, if that policy is still optimal, stops
+        after one step without factoring a new matrix. If there is no
+        such factorization, as after `funcit` or `setDiscount`, it only
+        starts from the last values.
+
         """
+        v, x = self._warmstart(v, policy=True)
         if v is None:
             v = sp.zeros(self.n)
-        ## Set initial values of x to such
-        x = sp.zeros(self.n) 
+        factor = None
+        if x is not None:
+            ## v are the values of the last policy, with its factorization
+            factor = self._factor
+        else:
+            ## No policy whose values are v: the first step cannot stop
+            x = -sp.ones(self.n, dtype=int)
         info = -1
         t = 0
+        exact = False
         for it in range(maxit):
             t += 1
             xold = x.copy()
+            vin = v
             v, x = self.valmax(v)
             pstar, fstar, ind = self.valpol(x)
-            Q = pstar * self.discount
-            eyeminus(Q)
+            if solver != 'direct':
+                ## The policy is optimal if it is the greedy policy of
+                ## its own values, evaluated to full precision
+                if exact and sp.all(x == xold):
+                    relres = la.norm(v - vin)
+                    info = 0
+                    break
+                method = {'gmres': spla.gmres,
+                          'bicgstab': spla.bicgstab}[solver]
+                A, M = _polop(pstar, self.discount)
+                ## Evaluate an unchanged policy to full precision
+                atol = tol
+                if not sp.all(x == xold):
+                    atol = max(tol, forcing * la.norm(v - vin))
+                vold = v
+                v, status = _krylov(method, A, fstar, vold, atol, M)
+                exact = atol == tol and status == 0
+                relres = la.norm(v - vold)
+                if verbose:
+                    print("%d, %f" % (it, relres))
+                continue
             if not gauss_seidel:
+                if factor is None or not factor.update(x, maxrank):
+                    factor = _PolicyFactor(self, x)
                 vold = v.copy()
-                v = la.solve(Q, fstar)
+                v = factor.solve(fstar)
                 relres = la.norm(v - vold)
+                if verbose:
+                    print("%d, %f" % (it, relres))
+                if sp.all(x == xold):
+                    info = 0
+                    break
+                continue
+            ## Gauss Seidel
+            Q = _polmatrix(pstar, self.discount)
+            if sparse.issparse(Q):
+                L = sparse.tril(Q, format='csc')
+                dv = spla.spsolve(L, fstar - Q.dot(v))
             else:
-                ## Gauss Seidel
                 L = sp.tril(Q)
                 dv = la.solve(L, fstar - sp.dot(Q, v))
-                relres = la.norm(dv)
-                v += dv
+            relres = la.norm(dv)
+            v += dv
             if verbose:
                 print("%d, %f" % (it, relres))
             if sp.all(x == xold):
                 info = 0
                 break
-        return (info, t, relres, v, x, pstar)
+        return self._solved((info, t, relres, v, x, pstar), factor)
 
-    @classmethod
-    def from_transfunc(cls, transfunc, **kwargs):
-        """Initialize with deterministic transition function
+    def logit(self, v=None, scale=1., maxit=100, tol=EPS, verbose=False):
+        r"""Solve smoothed Bellman equations with extreme value shocks
 
         Parameters
-        -------------
-        transfunc : array (n, m)
-             Deterministic transition function. Axes are
-             state, action.
-        """
-        kwargs['P'] = sp.asarray(_expandg(transfunc).todense())
-        return cls(**kwargs)        
+        --------------
+        v : array, shape (n, ), optional
+           Initial guess for values.
+        scale : float, optional
+           Scale of the extreme value shocks. See `logitmax`.
+        maxit : int, optional
+           Maximum number of iterations
+        tol : float, optional
+           Convergence tolerance, on the largest change of `v`.
 
-    @classmethod
-    def from_transprob(cls, transprob, **kwargs):
-        """Initialize with transaction probabilities
+        Returns
+        ------------
+        info : int
+            Exit status. 0 if converged. -1 if not.
+        t : int
+            Number of iterations
+        relres : float
+            Largest residual, :math:`\max |\Gamma(v) - v|`
+        v : array, shape (n, )
+        ccp : array, shape (n, m)
+            Conditional choice probabilities
+        pstar : array, shape (n, n)
+            Transition matrix of `ccp`
 
-        Parameters
-        -----------
-        transprob : array, shape (m, n, n)
-                  Stochastic transition matrix. The axes correspond to action,
-                  initial state, and next state.
+        Notes
+        --------
 
-        """
-        m = transprob.shape[0]
-        n = transprob.shape[1]
-        kwargs['P'] = sp.reshape(transprob, (m * n, n))
-        return cls(**kwargs)
+        Newton-Kantorovich iteration on :math:`v = \Gamma(v)`, the
+        smoothed Bellman equation of `logitmax`. The derivative of
+        :math:`\Gamma` is :math:`\delta P^*`, the transition matrix of
+        the choice probabilities, so each step solves
 
-    
-def ddpsimul(pstar, s, N, x):
+        .. math::
+            (I - \delta P^*) \Delta v = \Gamma(v) - v
+
+        as `newton` does for the hard max. It is the policy iteration of
+        the smoothed problem, and converges quadratically from any
+        starting values.
+        """
+        if v is None:
+            v = sp.zeros(self.n)
+        v = sp.array(v, dtype=float)
+        info = -1
+        t = 0
+        for it in range(maxit):
+            t += 1
+            vnew, ccp = self.logitmax(v, scale)
+            resid = vnew - v
+            relres = sp.absolute(resid).max()
+            if verbose:
+                print("%d, %f" % (it, relres))
+            if relres < tol:
+                v = vnew
+                info = 0
+                break
+            pstar = self.ccppol(ccp)
+            v += _polsolve(_polmatrix(pstar, self.discount), resid)
+        pstar = self.ccppol(ccp)
+        return (info, t, relres, v, ccp, pstar)
+
+    def prioritized(self, v=None, maxit=100, tol=EPS, batch=None):
+        r"""Solve Bellman equations by prioritized sweeping
+
+        Parameters
+        --------------
+        v : array, shape (n, ), optional
+           Initial guess for values.
+        maxit : int, optional
+           Maximum number of iterations, counted in backups of n
+           states, the work of one step of `funcit`.
+        tol : float, optional
+           Convergence tolerance
+        batch : int, optional
+           Number of states updated together. Default ``n // 16``.
+
+        Returns
+        ------------
+        info : int
+            Exit status. 0 if converged. -1 if not.
+        t : int
+            Number of iterations: backups of states, including the
+            full Bellman steps, divided by n and rounded up.
+        relres : float
+            Residual variance
+        v : array, shape (n, )
+        x : array, shape 
+        pstar : array, shape
+
+        Notes
+        --------
+
+        Asynchronous value iteration (Moore and Atkeson 1993). Each
+        state has a priority, an upper bound on its Bellman residual
+        :math:`|Tv(s) - v(s)|`. At each step the `batch` states of
+        highest priority are updated in place, with one `_backup` for
+        the batch, and their priorities are set to 0. A change of
+        :math:`\Delta` in the value of a state changes the Bellman
+        value of each of its predecessors (states that reach it under
+        some action, from the reverse adjacency of the union graph) by
+        at most :math:`\delta \Delta`, which is added to their
+        priorities, for all the states of the batch at once. States
+        whose priority stays below what can change the error bounds,
+        such as absorbing regions, are not updated.
+
+        In-place updates do not give error bounds. After n backups, or
+        when no priority is left, a full Bellman step gives the error
+        bounds of `funcit`, and its residuals reset the priorities.
+
+        It needs fewer backups than `funcit` when the residuals are
+        concentrated on few states. When they spread over the state
+        space, as in mixing models, the in-place updates slow the
+        convergence of the error bounds and `funcit` is faster.
+        """
+        v = self._warmstart(v)
+        if v is None:
+            v = sp.zeros(self.n)
+        v = sp.array(v, dtype=float)
+        n = self.n
+        if batch is None:
+            batch = max(n // 16, 1)
+        info = -1
+        delta = (self.discount) / (1 - self.discount)
+        relres = tol + 1
+        ## Residuals that cannot change the error bounds
+        small = tol / (4 * delta)
+        pred = self._union_graph().T.tocsr()
+        indeg = sp.diff(pred.indptr)
+        priority = sp.zeros(n)
+        backups = 0
+        work = 0
+        while backups < maxit * n:
+            if work == 0 or priority.max() <= small:
+                ## Full Bellman step
+                Tv, x = self.valmax(v)
+                backups += n
+                work = n
+                dv = Tv - v
+                lbound = delta * dv.min()
+                ubound = delta * dv.max()
+                relres = (ubound - lbound)
+                if relres < tol:
+                    v = Tv + (ubound + lbound) / 2
+                    info = 0
+                    break
+                v = Tv
+                priority = sp.absolute(dv)
+                continue
+            b = sp.flatnonzero(priority > small)
+            if len(b) > batch:
+                b = b[sp.argpartition(-priority[b], batch - 1)[:batch]]
+            vb = self._backup(v, b).max(1)
+            change = sp.absolute(vb - v[b])
+            v[b] = vb
+            priority[b] = 0
+            backups += len(b)
+            work = max(work - len(b), 0)
+            ## Push the changes to the predecessors
+            keep = change > small
+            b = b[keep]
+            bump = sp.zeros(n)
+            sp.maximum.at(bump, _csrcols(pred, b),
+                          sp.repeat(change[keep], indeg[b]))
+            priority += self.discount * bump
+        t = -(-backups // n)
+        if info != 0:
+            x = self.valmax(v)[1]
+        pstar = self.valpol(x)[0]
+        return self._solved((info, t, relres, v, x, pstar))
+
+    def sccsolve(self, method='newton', **kwargs):
+        r"""Solve Bellman equations by strongly connected components
+
+        Parameters
+        --------------
+        method : str, optional
+           Name of the method used to solve each subproblem.
+        kwargs :
+           Passed to the method.
+
+        Returns
+        ------------
+        info : int
+            Exit status. 0 if all subproblems converged. -1 if not.
+        t : int
+            Total number of iterations of the subproblems
+        relres : float
+            Largest residual of the subproblems
+        v : array, shape (n, )
+        x : array, shape 
+        pstar : array, shape
+
+        Notes
+        --------
+
+        The union over actions of the transition graphs is split into
+        strongly connected components. The graph of the components is
+        acyclic, so the values of a component only depend on the
+        values of the components it leads to. The components are solved
+        in reverse topological order: at each step, all the components
+        whose successors are solved form one subproblem, in which the
+        values of the solved states are fixed. The probability of
+        moving to a solved state goes to an extra absorbing state with
+        value 0, so that the subproblem is a stochastic model and the
+        error bounds of `funcit` still hold.
+
+        A component of a single state only depends on itself through
+        the probability of staying, and is solved in closed form,
+
+        .. math::
+            V(s) = \max_{x}
+            \frac{f(s, x) + \delta \sum_{s' \neq s} P(s' | s, x) V(s')}
+                 {1 - \delta P(s | s, x)}
+
+        for all the single states of a level at once. A subproblem is
+        only built for the larger components. Models with one-way
+        dynamics, like depletion of a stock, have no larger components.
+        For these models no subproblem is solved, and `t` is 0.
+
+        The components are found with
+        `scipy.sparse.csgraph.connected_components`. `markov.kosaraju`
+        finds the same sets but uses a dense matrix and recursion.
+        """
+        n = self.n
+        labels, level = self._scclevels()
+        single = (sp.bincount(labels) == 1)[labels]
+        ## States by level
+        lstate = level[labels]
+        order = sp.argsort(lstate, kind='mergesort')
+        ptr = sp.r_[0, sp.cumsum(sp.bincount(lstate))]
+        v = sp.zeros(n)
+        x = sp.zeros(n, dtype=int)
+        info = 0
+        t = 0
+        relres = 0.
+        for l in range(len(ptr) - 1):
+            states = sp.sort(order[ptr[l]:ptr[l + 1]])
+            one = states[single[states]]
+            if len(one):
+                ## v is still 0 on the states of this level
+                U = (self._backup(v, one)
+                     / (1 - self.discount * self._selfprob(one)))
+                v[one] = U.max(1)
+                x[one] = U.argmax(1)
+            states = states[~single[states]]
+            if not len(states):
+                continue
+            nc = len(states)
+            rows = (sp.r_[0:self.m][:, sp.newaxis] * n + states).ravel()
+            Prows = self._transrows(rows)
+            ## Values of the solved states enter as a fixed reward
+            vfixed = v.copy()
+            vfixed[states] = 0
+            fixed = sp.reshape(Prows.dot(vfixed), (self.m, nc)).T
+            reward = sp.zeros((nc + 1, self.m))
+            reward[:nc] = self.reward[states] + self.discount * fixed
+            ## The probability of leaving the subproblem goes to an
+            ## absorbing state with value 0, so that P stays stochastic
+            Pc = sparse.coo_matrix(Prows[:, states])
+            pexit = sp.maximum(1 - sp.asarray(Pc.sum(1)).ravel(), 0)
+            i = sp.r_[0:self.m * nc]
+            a = sp.r_[0:self.m]
+            Psub = sparse.coo_matrix(
+                (sp.r_[Pc.data, pexit, sp.ones(self.m)],
+                 (sp.r_[(Pc.row // nc) * (nc + 1) + Pc.row % nc,
+                        (i // nc) * (nc + 1) + i % nc,
+                        a * (nc + 1) + nc],
+                  sp.r_[Pc.col, sp.repeat(nc, self.m * nc + self.m)])),
+                shape=(self.m * (nc + 1), nc + 1)).tocsr()
+            if self._isdense():
+                Psub = Psub.toarray()
+            sub = Ddpsolve(discount=self.discount, reward=reward, P=Psub)
+            res = getattr(sub, method)(**kwargs)
+            if res[0] != 0:
+                info = -1
+            t += res[1]
+            relres = max(relres, res[2])
+            v[states] = res[3][:nc]
+            x[states] = res[4][:nc]
+        pstar = self.valpol(x)[0]
+        return self._solved((info, t, relres, v, x, pstar))
+
+    def _coarsen(self, R, Pr):
+        """ Aggregated model with restriction `R` and prolongation `Pr`
+
+        Rewards are averaged over each group, and transitions are
+        averaged over the states of a group and summed over the states
+        of the next group.
+        """
+        n = self.n
+        reward = sp.asarray(R.dot(self.reward))
+        blocks = [R.dot(sparse.csr_matrix(
+                        self._transrows(a * n + sp.r_[0:n]))).dot(Pr)
+                  for a in range(self.m)]
+        P = sparse.vstack(blocks).tocsr()
+        if self._isdense():
+            P = P.toarray()
+        return Ddpsolve(discount=self.discount, reward=reward, P=P)
+
+    def multigrid(self, v=None, factor=2, levels=2, nsmooth=2, maxit=100,
+                  tol=EPS):
+        r"""Solve Bellman equations by aggregation-disaggregation
+
+        Parameters
+        --------------
+        v : array, shape (n, ), optional
+           Initial guess for values. By default, the solution of the
+           aggregated model.
+        factor : int, optional
+           Number of consecutive states merged into a coarse state.
+        levels : int, optional
+           Number of grids used for the initial guess.
+        nsmooth : int, optional
+           Number of Bellman steps between coarse corrections.
+        maxit : int, optional
+           Maximum number of Bellman steps
+        tol : float, optional
+           Convergence tolerance
+
+        Returns
+        ------------
+        info : int
+            Exit status. 0 if converged. -1 if not.
+        t : int
+            Number of Bellman steps on the fine grid
+        relres : float
+            Residual variance
+        v : array, shape (n, )
+        x : array, shape 
+        pstar : array, shape
+
+        Notes
+        --------
+
+        States are assumed to be ordered on a grid, so that groups of
+        `factor` consecutive states are neighbours.
+
+        The aggregated model is solved (recursively, with `levels` - 1
+        grids) and its values prolonged to the fine grid as the initial
+        guess. On the fine grid, every `nsmooth` Bellman steps the error
+        :math:`e` of the current policy is approximated on the coarse
+        grid, by solving
+
+        .. math::
+            (I - \delta R P^* Pr) e_c = R \delta P^* (T v - v)
+
+        where `R` averages over groups and `Pr` copies group values back,
+        and :math:`Pr e_c` is added to the values. If a correction
+        increases the span of the residual, it is undone. Convergence is
+        checked with the error bounds of `funcit`.
+        """
+        R, Pr = _aggregation(self.n, factor)
+        v = self._warmstart(v)
+        if v is None:
+            coarse = self._coarsen(R, Pr)
+            if levels > 2 and coarse.n > factor:
+                vc = coarse.multigrid(factor=factor, levels=levels - 1,
+                                      nsmooth=nsmooth, maxit=maxit,
+                                      tol=tol)[3]
+            else:
+                vc = coarse.newton(tol=tol)[3]
+            v = Pr.dot(vc)
+        v = sp.array(v, dtype=float)
+        info = -1
+        delta = (self.discount) / (1 - self.discount)
+        t = 0
+        relres = tol + 1
+        vsafe = None
+        for it in range(maxit):
+            t += 1
+            Tv, x = self.valmax(v)
+            dv = Tv - v
+            lbound = delta * dv.min()
+            ubound = delta * dv.max()
+            if vsafe is not None and (ubound - lbound) > relres:
+                ## The correction made things worse
+                v = vsafe
+                vsafe = None
+                continue
+            relres = (ubound - lbound)
+            if relres < tol:
+                v = Tv + (ubound + lbound) / 2
+                info = 0
+                break
+            v = Tv
+            vsafe = None
+            if t % nsmooth == 0:
+                pstar = self.valpol(x)[0]
+                Pc = R.dot(sparse.csr_matrix(pstar)).dot(Pr)
+                ec = _polsolve(_polmatrix(Pc, self.discount),
+                               R.dot(self.discount * pstar.dot(dv)))
+                vsafe = v
+                v = v + Pr.dot(ec)
+        pstar = self.valpol(x)[0]
+        return self._solved((info, t, relres, v, x, pstar))
+
+    def modpolicy(self, v=None, k=20, maxit=100, tol=EPS):
+        r"""Solve Bellman equations by modified policy iteration
+
+        Parameters
+        --------------
+        v : array, shape (n, ), optional
+           Initial guess for values.
+        k : int, optional
+           Number of partial policy evaluation sweeps per
+           policy improvement step.
+        maxit : int, optional
+           Maximum number of iterations
+        tol : float, optional
+           Convergence tolerance
+
+        Returns
+        ------------
+        info : int
+            Exit status. 0 if converged. -1 if not.
+        t : int
+            Number of iterations
+        relres : float
+            Residual variance
+        v : array, shape (n, )
+        x : array, shape 
+        pstar : array, shape
+
+        Notes
+        --------
+
+        Each iteration is a policy improvement step, followed by `k`
+        iterations of
+
+        .. math::
+            v = f^* + \delta P^* v
+
+        With `k = 0` this is function iteration, and as `k` goes to
+        infinity it approaches policy iteration. Convergence is checked
+        on the improvement step with the same error bounds as `funcit`.
+
+        """
+        v = self._warmstart(v)
+        if v is None:
+            v = sp.zeros(self.n)
+        info = -1
+        delta = (self.discount) / (1 - self.discount)
+        t = 0
+        relres = tol + 1
+        for it in range(maxit):
+            t += 1
+            vold = v
+            v, x = self.valmax(vold)
+            lbound = delta * (v - vold).min()
+            ubound = delta * (v - vold).max()
+            relres = (ubound - lbound)
+            if relres < tol:
+                v += (ubound + lbound) / 2
+                info = 0
+                break
+            ## Partial policy evaluation
+            pstar, fstar, ind = self.valpol(x)
+            for j in range(k):
+                v = fstar + self.discount * pstar.dot(v)
+        pstar = self.valpol(x)[0]
+        return self._solved((info, t, relres, v, x, pstar))
+
+    @classmethod
+    def from_transfunc(cls, transfunc, dense=True, expand=True, **kwargs):
+        """Initialize with deterministic transition function
+
+        Parameters
+        -------------
+        transfunc : array (n, m)
+             Deterministic transition function. Axes are
+             state, action.
+        dense : bool, optional
+             If False, keep `P` as a CSR matrix.
+        expand : bool, optional
+             If False, do not build `P` at all. The model is solved
+             with the index-based Bellman operator on `transfunc`.
+        """
+        kwargs['g'] = transfunc
+        if expand:
+            P = _expandg(transfunc)
+            if dense:
+                P = sp.asarray(P.todense())
+            kwargs['P'] = P
+        return cls(**kwargs)        
+
+    @classmethod
+    def from_functions(cls, states, actions, reward_fn, next_state_fn,
+                       shocks=None, feasible_fn=None, dense=False, **kwargs):
+        """Initialize by evaluating functions over the state-action grid
+
+        Parameters
+        -------------
+        states : array, shape (n, )
+             Values of the states.
+        actions : array, shape (m, )
+             Values of the actions.
+        reward_fn : callable
+             ``reward_fn(s, x)``, called with broadcastable arrays of
+             shapes (n, 1) and (1, m). Returns the rewards, shape (n, m).
+        next_state_fn : callable
+             ``next_state_fn(s, x)``, or ``next_state_fn(s, x, e)`` if
+             `shocks` is given, with `e` of shape (1, 1, k). Returns the
+             values of the next states, which must be in `states`.
+        shocks : tuple (values, probs), optional
+             Values of the shock, shape (k, ), and their probabilities,
+             of shape (k, ) or broadcastable to (n, m, k) if they depend
+             on the state or action.
+        feasible_fn : callable, optional
+             ``feasible_fn(s, x)`` returns a boolean array, shape (n, m).
+             Infeasible actions get a reward of ``-inf`` and stay in
+             the same state.
+        dense : bool, optional
+             If True, store `P` as a dense array.
+
+        Notes
+        --------
+        The functions are called once, on the full grid, so they must
+        be vectorized. Without `shocks` the transitions are
+        deterministic and the model uses the index-based Bellman
+        operator, without `P`. With `shocks`, the probabilities are
+        summed into a CSR matrix `P` from COO triplets, so shocks that
+        lead to the same next state are added.
+        """
+        states = sp.asarray(states)
+        actions = sp.asarray(actions)
+        n, m = len(states), len(actions)
+        S = states[:, sp.newaxis]
+        X = actions[sp.newaxis, :]
+        ## Infeasible pairs may raise warnings (e.g. negative stocks)
+        with sp.errstate(all='ignore'):
+            if feasible_fn is None:
+                feasible = sp.ones((n, m), dtype=bool)
+            else:
+                feasible = sp.broadcast_to(feasible_fn(S, X), (n, m))
+            reward = sp.where(feasible,
+                              sp.broadcast_to(reward_fn(S, X), (n, m)),
+                              -sp.inf)
+            if shocks is None:
+                snext = sp.broadcast_to(next_state_fn(S, X), (n, m))
+            else:
+                e, pe = shocks
+                e = sp.asarray(e)
+                k = len(e)
+                snext = sp.broadcast_to(
+                    next_state_fn(S[..., sp.newaxis], X[..., sp.newaxis],
+                                  e[sp.newaxis, sp.newaxis, :]), (n, m, k))
+        kwargs['reward'] = reward
+        if shocks is None:
+            kwargs['g'] = _stateindex(states, sp.where(feasible, snext, S))
+            return cls(**kwargs)
+        feasible = feasible[..., sp.newaxis]
+        j = _stateindex(states, sp.where(feasible, snext, S[..., sp.newaxis]))
+        rows = sp.broadcast_to(sp.r_[0:m][:, sp.newaxis] * n + sp.r_[0:n],
+                               (k, m, n)).T
+        data = sp.broadcast_to(sp.asarray(pe, dtype=float), (n, m, k))
+        P = sparse.coo_matrix((data.ravel(), (rows.ravel(), j.ravel())),
+                              shape=(m * n, n)).tocsr()
+        P.eliminate_zeros()
+        if dense:
+            P = P.toarray()
+        kwargs['P'] = P
+        return cls(**kwargs)
+
+    @classmethod
+    def from_kron(cls, transfunc, exog, **kwargs):
+        """Initialize with an endogenous and an exogenous transition
+
+        Parameters
+        -------------
+        transfunc : array, shape (n, m) or (nx, m)
+             Next endogenous state, for each state and action. If it has
+             `nx` rows, it does not depend on the exogenous state.
+        exog : array, shape (ne, ne)
+             Transition matrix of the exogenous state, which does not
+             depend on the action.
+
+        Notes
+        --------
+        The states are ordered ``s = e * nx + z``, with `e` the
+        exogenous and `z` the endogenous state, so that the transition
+        matrix is the product of `exog` and the deterministic
+        endogenous transition. It is never built: the Bellman operator
+        first takes expectations over the next exogenous state,
+        ``W = dot(exog, v.reshape(ne, nx))``, in O(ne^2 nx), and then
+        gathers ``W[e, transfunc]``. A dense `P` would take
+        O(m n^2) memory and work.
+        """
+        exog = sp.asarray(exog, dtype=float)
+        ne = exog.shape[0]
+        n = kwargs['reward'].shape[0]
+        nx = n // ne
+        z = sp.asarray(transfunc).astype(int)
+        if z.shape[0] == nx and ne > 1:
+            z = sp.tile(z, (ne, 1))
+        e = sp.r_[0:n] // nx
+        kwargs['g'] = e[:, sp.newaxis] * nx + z
+        kwargs['exog'] = exog
+        return cls(**kwargs)
+
+    @classmethod
+    def from_transprob(cls, transprob, dense=True, **kwargs):
+        """Initialize with transaction probabilities
+
+        Parameters
+        -----------
+        transprob : array, shape (m, n, n)
+                  Stochastic transition matrix. The axes correspond to action,
+                  initial state, and next state.
+        dense : bool, optional
+                  If False, store `P` as a CSR matrix.
+
+        """
+        m = transprob.shape[0]
+        n = transprob.shape[1]
+        P = sp.reshape(transprob, (m * n, n))
+        if not dense:
+            P = sparse.csr_matrix(P)
+        kwargs['P'] = P
+        return cls(**kwargs)
+
+
+def _toshared(a):
+    """ Copy an array into shared memory
+
+    Returns a tuple that `_fromshared` turns back into an array, and
+    that can be passed to child processes without copying the data.
+    """
+    a = sp.ascontiguousarray(a)
+    raw = sharedctypes.RawArray('b', a.nbytes)
+    sp.frombuffer(raw, dtype=a.dtype).reshape(a.shape)[...] = a
+    return (raw, a.dtype.str, a.shape)
+
+def _fromshared(shared):
+    """ Array view of the shared memory from `_toshared` """
+    raw, dtype, shape = shared
+    return sp.frombuffer(raw, dtype=dtype).reshape(shape)
+
+## Data of ddpsweep in the worker processes
+_SWEEP = {}
+
+def _sweep_init(P, rewards, discounts, features, method, kwargs):
+    """ Initialize a ddpsweep worker """
+    if isinstance(P, tuple) and len(P) == 4:
+        data, indices, indptr, shape = P
+        P = sparse.csr_matrix((_fromshared(data), _fromshared(indices),
+                               _fromshared(indptr)), shape=shape)
+    else:
+        P = _fromshared(P)
+    _SWEEP.update(P=P, rewards=_fromshared(rewards), discounts=discounts,
+                  features=features, method=method, kwargs=kwargs)
+
+def _sweep_chunk(chunk):
+    """ Solve the variants in `chunk`, each one starting from the
+    solution of the nearest variant already solved in the chunk """
+    P = _SWEEP['P']
+    features = _SWEEP['features']
+    solved = []
+    res = []
+    for i in chunk:
+        model = Ddpsolve(discount=_SWEEP['discounts'][i],
+                         reward=_SWEEP['rewards'][i], P=P)
+        v = None
+        if solved:
+            dist = [sp.sum((features[i] - features[j]) ** 2) for j in solved]
+            v = res[sp.argmin(dist)][4]
+        info, t, relres, v, x = getattr(model, _SWEEP['method'])(
+            v=v, **_SWEEP['kwargs'])[:5]
+        solved.append(i)
+        res.append((i, info, t, relres, v, x))
+    return res
+
+def ddpsweep(discounts, rewards, P, processes=None, params=None,
+             method='funcit', **kwargs):
+    """ Solve many variants of a model that share one transition matrix
+
+    Parameters
+    ------------
+    discounts : array, shape (B, )
+        Discount factor of each variant
+    rewards : array, shape (B, n, m)
+        Reward of each variant
+    P : array or sparse matrix, shape (m * n, n)
+        Transition matrix shared by all the variants
+    processes : int, optional
+        Number of worker processes. Defaults to the number of CPUs.
+        With 1, the variants are solved in this process.
+    params : array, shape (B, k), optional
+        Parameters of the variants, used to find the nearest neighbour
+        of a variant. Defaults to the discount and the finite rewards.
+    method : str, optional
+        Name of the `Ddpsolve` method used to solve each variant.
+    kwargs :
+        Passed to the method.
+
+    Returns
+    ----------
+    info : array, shape (B, )
+    t : array, shape (B, )
+    relres : array, shape (B, )
+    v : array, shape (n, B)
+    x : array, shape (n, B)
+
+    Notes
+    -------
+
+    `P` and `rewards` are copied once into shared memory, which the
+    worker processes read without pickling them. The variants are
+    sorted by `params` and split into one contiguous chunk per
+    process. Within a chunk, each variant starts from the solution of the
+    nearest variant (in `params`) already solved.
+    """
+    discounts = sp.asarray(discounts, dtype=float)
+    rewards = sp.asarray(rewards, dtype=float)
+    B, n, m = rewards.shape
+    if params is None:
+        params = sp.column_stack((discounts, rewards.reshape((B, -1))))
+        params[~sp.isfinite(params)] = 0
+    params = sp.asarray(params, dtype=float).reshape((B, -1))
+    if processes is None:
+        processes = multiprocessing.cpu_count()
+    ## Contiguous chunks of sorted variants
+    order = sp.lexsort(params.T[::-1])
+    nchunks = min(B, processes)
+    chunks = [c.tolist() for c in sp.array_split(order, nchunks)]
+    if sparse.issparse(P):
+        P = sparse.csr_matrix(P)
+        shared = (_toshared(P.data), _toshared(P.indices),
+                  _toshared(P.indptr), P.shape)
+    else:
+        shared = _toshared(sp.asarray(P, dtype=float))
+    initargs = (shared, _toshared(rewards), discounts, params, method,
+                kwargs)
+    if processes == 1:
+        _sweep_init(*initargs)
+        results = [_sweep_chunk(c) for c in chunks]
+    else:
+        pool = multiprocessing.Pool(processes, initializer=_sweep_init,
+                                    initargs=initargs)
+        try:
+            results = pool.map(_sweep_chunk, chunks)
+        finally:
+            pool.close()
+            pool.join()
+    info = sp.zeros(B, dtype=int)
+    t = sp.zeros(B, dtype=int)
+    relres = sp.zeros(B)
+    v = sp.zeros((n, B))
+    x = sp.zeros((n, B), dtype=int)
+    for res in results:
+        for i, info_i, t_i, relres_i, v_i, x_i in res:
+            info[i] = info_i
+            t[i] = t_i
+            relres[i] = relres_i
+            v[:, i] = v_i
+            x[:, i] = x_i
+    return (info, t, relres, v, x)
+
+def tvbacksolve(stages, T, discount, vterm=None):
+    """ Solve a finite horizon model whose rewards and transitions vary
+    over time
+
+    Parameters
+    ------------
+    stages : callable or iterable
+        ``stages(t)`` returns ``(reward_t, P_t)``, the reward, shape
+        (n, m), and transition matrix, shape (m * n, n), of period `t`.
+        Or an iterable, such as a generator, that yields them for
+        ``t = T - 1, ..., 0``, in that order. `P_t` may be dense or
+        sparse.
+    T : int
+        Number of periods
+    discount : float or array, shape (T, )
+        Discount factor, or the discount factor of each period.
+    vterm : array, shape (n, ) or (n, 1), optional
+        Terminal values. Defaults to zeros.
+
+    Returns
+    ----------
+    x : array, shape (n, T)
+        Optimal controls, of the smallest integer type that holds the
+        actions.
+    v : array, shape (n, T + 1)
+        Value function.
+
+    Notes
+    -------
+
+    The periods are solved backwards with `Ddpsolve.valmax`, and the
+    data of a period is released before the next one is requested, so
+    only one period of rewards and transitions is in memory at a time.
+    Unlike `Ddpsolve.backsolve`, no transition matrices of the policy
+    are returned, since they would need all the `P_t`.
+    """
+    discount = sp.broadcast_to(sp.asarray(discount, dtype=float), (T, ))
+    if callable(stages):
+        stage = stages
+        stages = (stage(t) for t in range(T - 1, -1, -1))
+    stages = iter(stages)
+    x = None
+    v = None
+    for t in range(T - 1, -1, -1):
+        try:
+            reward, P = next(stages)
+        except StopIteration:
+            raise ValueError("stages ended before period 0")
+        model = Ddpsolve(discount=discount[t], reward=reward, P=P,
+                         warm_start=False)
+        del reward, P
+        if x is None:
+            n, m = model.n, model.m
+            x = sp.zeros((n, T), dtype=sp.min_scalar_type(m - 1))
+            v = sp.zeros((n, T + 1))
+            if vterm is not None:
+                v[:, T] = sp.asarray(vterm, dtype=float).reshape(n)
+        v[:, t], x[:, t] = model.valmax(v[:, t + 1])
+        del model
+    return (x, v)
+
+class PolicyTransitions(object):
+    """ Transition matrices of a finite horizon policy, built on demand
+
+    Stands in for the (n, n, T) array `pstar` of `Ddpsolve.backsolve`,
+    while only storing the policy `x`.
+
+    Attributes
+    -----------
+    model : Ddpsolve
+        Model
+    x : array, shape (n, T)
+        Optimal controls
+    shape : tuple
+        (n, n, T)
+
+    Notes
+    ------
+
+    ``pstar[..., t]`` returns the transition matrix of period `t`, and
+    ``pstar.rows(s, t)`` only its rows `s`. Both have the type of the
+    rows of `model.P`, or are CSR matrices if `P` is not stored.
+    """
+
+    def __init__(self, model, x):
+        self.model = model
+        self.x = x
+        self.shape = (model.n, model.n, x.shape[1])
+
+    def __getitem__(self, key):
+        if not (isinstance(key, tuple) and len(key) == 2
+                and key[0] is Ellipsis):
+            raise IndexError("Only pstar[..., t] is supported")
+        return self.model.valpol(self.x[:, key[1]])[0]
+
+    def rows(self, s, t):
+        """ Rows `s` of the transition matrix of period `t` """
+        s = sp.asarray(s)
+        return self.model._transrows(self.x[s, t] * self.model.n + s)
+
+def _pstar_t(pstar, t):
+    """ Transition matrix of period `t` of a finite horizon pstar """
+    if isinstance(pstar, list):
+        return pstar[t]
+    return pstar[..., t]
+
+def _rowcdf(P):
+    """ Row cumulative distributions of a transition matrix
+
+    Returns
+    ---------
+    keys : array, shape (nnz, )
+        Cumulative probabilities within each row, plus the row index.
+        `keys` is sorted, and the keys of row `i` are in (i, i + 1].
+    indices : array, shape (nnz, )
+        Column of each key
+    indptr : array, shape (n + 1, )
+        The keys of row `i` are ``keys[indptr[i]:indptr[i + 1]]``.
+    """
+    P = sparse.csr_matrix(P)
+    P.eliminate_zeros()
+    counts = sp.diff(P.indptr)
+    c = sp.r_[0., sp.cumsum(P.data)]
+    start = c[P.indptr[:-1]]
+    total = c[P.indptr[1:]] - start
+    rows = sp.repeat(sp.r_[0:P.shape[0]], counts)
+    keys = (c[1:] - start[rows]) / total[rows] + rows
+    return (keys, P.indices, P.indptr)
+
+def _draw(cdf, s, u):
+    """ Next states from states `s` and uniform draws `u`
+
+    Binary search of ``s + u`` in the row cumulative distributions
+    from `_rowcdf`.
+    """
+    keys, indices, indptr = cdf
+    pos = sp.searchsorted(keys, s + u, side='right')
+    ## Rounding of s + u
+    pos = sp.minimum(pos, indptr[s + 1] - 1)
+    return indices[pos]
+
+def _horizon(x, N):
+    """ Number of periods that can be simulated with controls `x` """
+    if x.ndim == 1:
+        return N
+    T = x.shape[1]
+    if N > T:
+        print("Simulations greater than the time horizon are ignored.")
+    return min(N, T)
+
+def _actions(x, s, t):
+    """ Actions in states `s` in period `t`, -1 after the horizon """
+    if x.ndim == 1:
+        return x[s]
+    if t < x.shape[1]:
+        return x[s, t]
+    return -sp.ones(len(s), int)
+
+def _simulate(pstar, s, N, x, g, rng, cdf=None):
+    """ Generate the states of all paths in periods 0, ..., N
+
+    `cdf` are the row cumulative distributions of an infinite horizon
+    `pstar`, if already computed.
+    """
+    infinite = (x.ndim == 1)
+    k = len(s)
+    if g is not None:
+        g = sp.asarray(g).astype(int)
+    elif infinite and cdf is None:
+        cdf = _rowcdf(pstar)
+    yield s
+    for t in range(N):
+        xt = x if infinite else x[:, t]
+        if g is not None:
+            s = g[s, xt[s]]
+        else:
+            if not infinite:
+                cdf = _rowcdf(_pstar_t(pstar, t))
+            s = _draw(cdf, s, rng.random(k))
+        yield s
+
+def _paths(pstar, s, N, x, g, rng, cdf=None):
+    """ Simulated states and actions, shape (k, N + 1) """
+    k = len(s)
+    spath = sp.zeros((k, N + 1), int)
+    xpath = sp.zeros((k, N + 1), int)
+    for t, st in enumerate(_simulate(pstar, s, N, x, g, rng, cdf)):
+        spath[:, t] = st
+        xpath[:, t] = _actions(x, st, t)
+    return (spath, xpath)
+
+def ddpsimul(pstar, s, N, x, g=None, rng=None):
     """ Monte-Carlo simulation of discrete-state/action controlled Markov process
 
     Parameters
@@ -304,44 +2351,242 @@ def ddpsimul(pstar, s, N, x):
     pstar : array, shape (n, n) or (n, n, T)
       Optimal state transition matrix. Usually returned by one of the methods of
       `Dpsolve`. The array has shape (n, n) for infinite horizon processes,
-      and (n, n, T) for finite horizon processes.
+      and (n, n, T) for finite horizon processes. A CSR matrix is
+      accepted for infinite horizon processes, and a list of CSR
+      matrices or a `PolicyTransitions` for finite horizon processes.
     s : array, shape (k, )
       Initial states
     N : int
       Number of simulations
     x : array, shape (n, ) or (n, T)
       Optimal controls
+    g : array, shape (n, m), optional
+      Deterministic transition function. If given, the next state is
+      `g[s, x[s]]` and `pstar` is ignored (it may be `None`).
+    rng : numpy.random.Generator or int, optional
+      Random number generator, or a seed for `numpy.random.default_rng`.
 
     Returns
     ---------
     spath : array, shape (k, N + 1)
        Simulated states
+    xpath : array, shape (k, N + 1)
+       Actions in the simulated states. For finite horizon processes
+       the action of period `T` is not defined and is set to -1.
+
+    Notes
+    -------
+
+    The cumulative distribution of each row of `pstar` is computed
+    once (once per period for finite horizon processes). Each period
+    draws one uniform number per path, and finds the next state by
+    binary search, so a period costs O(k log(nnz)).
     
     """
-    infinite = (len(pstar.shape) == 2)
-    n = pstar.shape[1]
+    rng = default_rng(rng)
+    s = sp.asarray(s, dtype=int)
+    N = _horizon(x, N)
+    return _paths(pstar, s, N, x, g, rng)
+
+def ddpsimul_chunks(pstar, s, N, x, chunksize=10000, axis=0, g=None,
+                    rng=None):
+    """ Monte-Carlo simulation in blocks of paths or periods
+
+    Parameters
+    -------------
+    pstar, s, N, x, g, rng :
+      As in `ddpsimul`.
+    chunksize : int, optional
+      Number of paths (`axis` = 0) or periods (`axis` = 1) per block.
+    axis : {0, 1}, optional
+      Split the simulation into blocks of paths (0) or of periods (1).
+
+    Yields
+    ---------
+    start : int
+      Index of the first path or period of the block.
+    spath : array, shape (chunksize, N + 1) or (k, chunksize)
+      Simulated states of the block.
+    xpath : array
+      Actions in the simulated states, same shape as `spath`.
+
+    Notes
+    -------
+
+    Only one block is kept in memory. Blocks of periods use the random
+    draws in the same order as `ddpsimul`, so that together they are
+    the same paths. Blocks of paths draw each block separately.
+    """
+    return _chunks(pstar, s, _horizon(x, N), x, chunksize, axis, g, rng)
+
+def _chunks(pstar, s, N, x, chunksize, axis, g, rng):
+    """ Blocks of `ddpsimul_chunks`, for `N` within the horizon """
+    rng = default_rng(rng)
+    s = sp.asarray(s, dtype=int)
     k = len(s)
-    spath = sp.zeros((k, N+1), int)
-    if infinite:
-        ## Row cumulative sum
-        cp = pstar.cumsum(1)
-        spath[:, 0] = s
-        for t in range(1, N + 1):
-            ## Draws the column from a categorical distribution
-            rdraw = random.rand(k, 1)
-            s = (sp.repeat(rdraw, n, 1) > cp[s, ]).sum(1)
-            spath[:, t] = s
+    if axis == 1:
+        for t, st in enumerate(_simulate(pstar, s, N, x, g, rng)):
+            if t % chunksize == 0:
+                start = t
+                width = min(chunksize, N + 1 - t)
+                spath = sp.zeros((k, width), int)
+                xpath = sp.zeros((k, width), int)
+            spath[:, t - start] = st
+            xpath[:, t - start] = _actions(x, st, t)
+            if t - start == width - 1:
+                yield (start, spath, xpath)
     else:
-        T = pstar.shape[2]
-        if N > T:
-            print("Simulations greater than the time horizon are ignored.")
-        N = min(N, T)
-        spath[:, 0] = s
-        for t in range(N + 1):
-            cp = pstar[...,t].cumsum(1)
-            rdraw = random.rand(k, 1)
-            s = (sp.repeat(rdraw, n, 1) > cp[s, ]).sum(1)
-
-    xpath = x[spath]
+        cdf = None
+        if g is None and x.ndim == 1:
+            cdf = _rowcdf(pstar)
+        for start in range(0, k, chunksize):
+            spath, xpath = _paths(pstar, s[start:start + chunksize], N, x,
+                                  g, rng, cdf)
+            yield (start, spath, xpath)
+
+## Data of ddpsimul_parallel in the worker processes
+_SIMUL = {}
+
+def _simul_init(pstar, N, x, g):
+    """ Initialize a ddpsimul_parallel worker """
+    if isinstance(pstar, tuple) and len(pstar) == 3:
+        pstar = _fromshared(pstar)
+    cdf = None
+    if g is None and x.ndim == 1:
+        cdf = _rowcdf(pstar)
+    _SIMUL.update(pstar=pstar, N=N, x=x, g=g, cdf=cdf)
+
+def _simul_block(args):
+    """ Simulate one block of paths with its own random stream """
+    s, seed = args
+    return _paths(_SIMUL['pstar'], s, _SIMUL['N'], _SIMUL['x'], _SIMUL['g'],
+                  default_rng(seed), _SIMUL['cdf'])
+
+def ddpsimul_parallel(pstar, s, N, x, seed=None, processes=None,
+                      chunksize=10000, g=None):
+    """ Reproducible Monte-Carlo simulation in a process pool
+
+    Parameters
+    -------------
+    pstar, s, N, x, g :
+      As in `ddpsimul`.
+    seed : int or numpy.random.SeedSequence, optional
+      Seed of the simulation.
+    processes : int, optional
+      Number of worker processes. Defaults to the number of CPUs.
+      With 1, the blocks are simulated in this process.
+    chunksize : int, optional
+      Number of paths per block.
+
+    Returns
+    ---------
+    spath : array, shape (k, N + 1)
+       Simulated states
+    xpath : array, shape (k, N + 1)
+       Actions in the simulated states
+
+    Notes
+    -------
+
+    The initial states are split into blocks of `chunksize` paths.
+    Block `b` draws from its own generator, seeded with the `b`-th
+    child of ``SeedSequence(seed).spawn``. The paths only depend on
+    `seed` and `chunksize`, not on the number of processes.
+    """
+    s = sp.asarray(s, dtype=int)
+    N = _horizon(x, N)
+    if not isinstance(seed, SeedSequence):
+        seed = SeedSequence(seed)
+    starts = range(0, len(s), chunksize)
+    seeds = seed.spawn(len(starts))
+    blocks = [(s[i:i + chunksize], seeds[b]) for b, i in enumerate(starts)]
+    if processes is None:
+        processes = multiprocessing.cpu_count()
+    if processes == 1:
+        _simul_init(pstar, N, x, g)
+        results = [_simul_block(b) for b in blocks]
+    else:
+        if isinstance(pstar, sp.ndarray):
+            pstar = _toshared(pstar)
+        initargs = (pstar, N, x, g)
+        pool = multiprocessing.Pool(processes, initializer=_simul_init,
+                                    initargs=initargs)
+        try:
+            results = pool.map(_simul_block, blocks)
+        finally:
+            pool.close()
+            pool.join()
+    spath = sp.vstack([res[0] for res in results])
+    xpath = sp.vstack([res[1] for res in results])
+    return (spath, xpath)
+
+def ddpsimul_save(pstar, s, N, x, filename, xfilename=None,
+                  chunksize=10000, g=None, rng=None):
+    """ Monte-Carlo simulation written to ``.npy`` files
+
+    Parameters
+    -------------
+    pstar, s, N, x, g, rng :
+      As in `ddpsimul`.
+    filename : str
+      File for the simulated states.
+    xfilename : str, optional
+      File for the actions in the simulated states.
+    chunksize : int, optional
+      Number of paths simulated at a time.
+
+    Returns
+    ---------
+    spath : memmap, shape (k, N + 1)
+    xpath : memmap, shape (k, N + 1) or None
+    """
+    N = _horizon(x, N)
+    shape = (len(s), N + 1)
+    spath = open_memmap(filename, mode='w+', dtype=int, shape=shape)
+    xpath = None
+    if xfilename is not None:
+        xpath = open_memmap(xfilename, mode='w+', dtype=int, shape=shape)
+    for start, sblock, xblock in _chunks(pstar, s, N, x, chunksize, 0, g,
+                                         rng):
+        spath[start:start + sblock.shape[0]] = sblock
+        if xpath is not None:
+            xpath[start:start + xblock.shape[0]] = xblock
+    spath.flush()
+    if xpath is not None:
+        xpath.flush()
     return (spath, xpath)
 
+def ddpsimul_summary(pstar, s, N, x, g=None, rng=None):
+    """ Summary statistics of a Monte-Carlo simulation
+
+    Parameters
+    -------------
+    pstar, s, N, x, g, rng :
+      As in `ddpsimul`.
+
+    Returns
+    ---------
+    occupancy : array, shape (N + 1, n)
+      Number of paths in each state in each period.
+    xmean : array, shape (N + 1, )
+      Mean action in each period. `nan` after the horizon of a finite
+      horizon process.
+
+    Notes
+    -------
+
+    The statistics are accumulated period by period, so only the
+    current states of the paths are kept in memory. The draws are the
+    same as those of `ddpsimul` with the same `rng`.
+    """
+    rng = default_rng(rng)
+    s = sp.asarray(s, dtype=int)
+    n = x.shape[0]
+    N = _horizon(x, N)
+    occupancy = sp.zeros((N + 1, n), int)
+    xmean = sp.zeros(N + 1)
+    for t, st in enumerate(_simulate(pstar, s, N, x, g, rng)):
+        occupancy[t] = sp.bincount(st, minlength=n)
+        xt = _actions(x, st, t)
+        xmean[t] = xt.mean() if xt.min() >= 0 else sp.nan
+    return (occupancy, xmean)
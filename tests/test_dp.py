@@ -0,0 +1,524 @@
+""" Tests of psc585.dp """
+import pytest
+import scipy as sp
+from scipy import sparse
+
+from psc585 import dp
+
+
+def _ddp01_loops(sbar=10):
+    """ Reward and transition function of ddp01, built with loops """
+    n = m = sbar + 1
+    f = sp.zeros((n, m))
+    g = sp.zeros((n, m), dtype=int)
+    for i in range(n):
+        for j in range(m):
+            if j <= i:
+                f[i, j] = j - j ** 2 / (1. + i)
+                g[i, j] = i - j
+            else:
+                f[i, j] = -sp.inf
+    return f, g
+
+
+def _demddp05_loops(maxcap=30):
+    """ Reward and transition matrix of demddp05, built with loops """
+    r = sp.array([0, 1, 2, 3, 4])
+    p = sp.array([0.1, 0.2, 0.4, 0.2, 0.1])
+    n = m = maxcap + 1
+    f = sp.zeros((n, m))
+    P = sp.zeros((m, n, n))
+    for i in range(n):
+        for k in range(m):
+            if k > i:
+                f[i, k] = -sp.inf
+                continue
+            geq = int(i - k >= 10)
+            f[i, k] = 14 * k ** 0.8 + 10 * max(0, (i - k) * geq) ** 0.4
+            for j in range(len(r)):
+                P[k, i, min(i - k + r[j], maxcap)] += p[j]
+    return f, P, r, p
+
+
+def test_from_functions_ddp01():
+    f, g = _ddp01_loops()
+    S = sp.r_[0:11]
+    model = dp.Ddpsolve.from_functions(
+        S, S, lambda s, x: x - x ** 2 / (1. + s), lambda s, x: s - x,
+        feasible_fn=lambda s, x: x <= s, discount=0.9)
+    assert sp.array_equal(model.reward, f)
+    feasible = sp.isfinite(f)
+    assert sp.array_equal(model.g[feasible], g[feasible])
+    ref = dp.Ddpsolve(discount=0.9, reward=f, g=g).newton()
+    res = model.newton()
+    assert sp.allclose(res[3], ref[3])
+    assert sp.array_equal(res[4], ref[4])
+
+
+def test_from_functions_demddp05():
+    maxcap = 30
+    f, P, r, p = _demddp05_loops(maxcap)
+    S = sp.r_[0:maxcap + 1]
+
+    def reward(s, x):
+        return 14 * x ** 0.8 + 10 * sp.maximum(0, (s - x) * (s - x >= 10)) ** 0.4
+
+    model = dp.Ddpsolve.from_functions(
+        S, S, reward, lambda s, x, e: sp.minimum(s - x + e, maxcap),
+        shocks=(r, p), feasible_fn=lambda s, x: x <= s, discount=0.9)
+    assert sparse.issparse(model.P)
+    feasible = sp.isfinite(f)
+    assert sp.array_equal(sp.isfinite(model.reward), feasible)
+    assert sp.allclose(model.reward[feasible], f[feasible])
+    ## Rows of P of the feasible pairs, axes state, action, next state
+    P3 = model.P.toarray().reshape(P.shape).transpose((1, 0, 2))
+    assert sp.allclose(P3[feasible], P.transpose((1, 0, 2))[feasible])
+    ref = dp.Ddpsolve.from_transprob(P, reward=f, discount=0.9).newton()
+    res = model.newton()
+    assert sp.allclose(res[3], ref[3])
+    assert sp.array_equal(res[4], ref[4])
+
+
+def _ddp06():
+    """ Bioeconomic model of ddp06 """
+    emax = 8
+    e = sp.array([2, 4, 4])
+    p = sp.array([1.0, 0.7, 0.8])
+    q = sp.array([0.5, 0.8, 0.7])
+    n, m = emax + 1, 3
+    P = sp.zeros((m, n, n))
+    for k in range(m):
+        P[k, 0, 0] = 1
+        for i in range(1, n):
+            P[k, i, 0] += 1 - p[k]
+            P[k, i, min(i - 1 + e[k], emax)] += p[k] * q[k]
+            P[k, i, i - 1] += p[k] * (1 - q[k])
+    vterm = sp.ones(n)
+    vterm[0] = 0
+    return dp.Ddpsolve.from_transprob(P, reward=sp.zeros((n, m)),
+                                      discount=1, T=10, vterm=vterm)
+
+
+def test_backsolve_memmap(tmp_path):
+    model = _ddp06()
+    x, v, pstar = model.backsolve(store='array')
+    filename = str(tmp_path / "pstar.npy")
+    xm, vm, pm = model.backsolve(store='memmap', filename=filename)
+    assert sp.array_equal(xm, x)
+    assert sp.array_equal(vm, v)
+    assert sp.array_equal(sp.load(filename), pstar)
+
+
+def test_ddpsimul_save(tmp_path, capsys):
+    model = _ddp06()
+    x, v, pstar = model.backsolve()
+    s = sp.r_[0:model.n].repeat(3)
+    spath, xpath = dp.ddpsimul(pstar, s, 20, x, rng=0)
+    out = capsys.readouterr().out
+    assert out.count("time horizon") == 1
+    sm, xm = dp.ddpsimul_save(pstar, s, 20, x, str(tmp_path / "s.npy"),
+                              str(tmp_path / "x.npy"), rng=0)
+    assert capsys.readouterr().out == out
+    assert sp.array_equal(sp.load(str(tmp_path / "s.npy")), spath)
+    assert sp.array_equal(sp.load(str(tmp_path / "x.npy")), xpath)
+
+
+def test_ddpsimul_parallel():
+    f, P, r, p = _demddp05_loops()
+    res = dp.Ddpsolve.from_transprob(P, reward=f, discount=0.9).newton()
+    model = _ddp06()
+    x, v, pstar = model.backsolve()
+    cases = [(res[5], sp.r_[0:31].repeat(10), 15, res[4]),
+             (pstar, sp.r_[0:model.n].repeat(30), 10, x)]
+    for pstar, s, N, x in cases:
+        one = dp.ddpsimul_parallel(pstar, s, N, x, seed=5, processes=1,
+                                   chunksize=40)
+        two = dp.ddpsimul_parallel(pstar, s, N, x, seed=5, processes=2,
+                                   chunksize=40)
+        assert one[0].shape == (len(s), N + 1)
+        assert sp.array_equal(one[0], two[0])
+        assert sp.array_equal(one[1], two[1])
+        assert sp.array_equal(one[0][:, 0], s)
+
+
+def test_funcit_batch():
+    f, P, r, p = _demddp05_loops()
+    fg, g = _ddp01_loops(30)
+    models = [lambda f: dp.Ddpsolve.from_transprob(P, reward=f, discount=0.9),
+              lambda f: dp.Ddpsolve.from_transprob(P, reward=f, discount=0.9,
+                                                   compact=True),
+              lambda f: dp.Ddpsolve(discount=0.9, reward=f, g=g)]
+    for model, f in zip(models, (f, f, fg)):
+        rewards = sp.array([f, 2 * f + 1, f - 0.1 * sp.r_[0:f.shape[1]]])
+        res = model(f).funcit_batch(rewards)
+        for b in range(len(rewards)):
+            ref = model(rewards[b]).funcit()
+            assert res[0][b] == ref[0] == 0
+            assert res[1][b] == ref[1]
+            assert sp.array_equal(res[4][:, b], ref[4])
+            assert sp.allclose(res[3][:, b], ref[3])
+
+
+def test_compact():
+    f, P, r, p = _demddp05_loops()
+    fg, g = _ddp01_loops(30)
+    models = [lambda c: dp.Ddpsolve.from_transprob(P, reward=f, discount=0.9,
+                                                   compact=c),
+              lambda c: dp.Ddpsolve.from_transprob(P, reward=f, discount=0.9,
+                                                   dense=False, compact=c),
+              lambda c: dp.Ddpsolve(discount=0.9, reward=fg, g=g, compact=c)]
+    for model in models:
+        full = model(False)
+        compact = model(True)
+        assert compact.pairs is not None
+        assert compact.P is None
+        v = sp.r_[0:full.n] / 3.
+        ref = full.valmax(v)
+        res = compact.valmax(v)
+        assert sp.allclose(res[0], ref[0])
+        assert sp.array_equal(res[1], ref[1])
+        for method, kwargs in (('newton', {}),
+                               ('funcit', {'eliminate': True})):
+            ref = getattr(full, method)(**kwargs)
+            res = getattr(compact, method)(**kwargs)
+            assert res[:2] == ref[:2]
+            assert sp.allclose(res[3], ref[3])
+            assert sp.array_equal(res[4], ref[4])
+
+
+def test_logit():
+    f, P, r, p = _demddp05_loops()
+    fg, g = _ddp01_loops(30)
+    models = [dp.Ddpsolve.from_transprob(P, reward=f, discount=0.9),
+              dp.Ddpsolve.from_transprob(P, reward=f, discount=0.9,
+                                         compact=True),
+              dp.Ddpsolve(discount=0.9, reward=fg, g=g)]
+    for model in models:
+        res = model.logit(scale=0.5)
+        assert res[0] == 0
+        ## Plain fixed point iteration of the smoothed Bellman equation
+        v = sp.zeros(model.n)
+        for it in range(500):
+            v, ccp = model.logitmax(v, scale=0.5)
+        assert sp.allclose(res[3], v)
+        assert sp.allclose(res[4], ccp)
+        assert sp.allclose(res[4].sum(1), 1)
+        assert sp.all(res[4][~sp.isfinite(model.reward)] == 0)
+        assert sp.allclose(res[5].sum(1), 1)
+
+
+def test_funcit_eliminate(monkeypatch):
+    scored = []
+    segmax = dp._segmax
+
+    def counted(U, ptr):
+        scored.append(len(U))
+        return segmax(U, ptr)
+    monkeypatch.setattr(dp, '_segmax', counted)
+    f, P, r, p = _demddp05_loops()
+    fg, g = _ddp01_loops(30)
+    models = [lambda: dp.Ddpsolve.from_transprob(P, reward=f, discount=0.9),
+              lambda: dp.Ddpsolve.from_transprob(P, reward=f, discount=0.9,
+                                                 dense=False),
+              lambda: dp.Ddpsolve(discount=0.9, reward=fg, g=g)]
+    for model in models:
+        ref = model().funcit()
+        del scored[:]
+        m = model()
+        res = m.funcit(eliminate=True)
+        assert res[:2] == ref[:2]
+        assert sp.allclose(res[3], ref[3])
+        assert sp.array_equal(res[4], ref[4])
+        ## The later iterations only score the remaining pairs
+        assert len(scored) > 0
+        assert max(scored) <= m.n * m.m // 2
+
+
+def test_from_kron():
+    ## Harvest of a stock that grows by 2, at a Markov price
+    nx, ne, m = 12, 3, 6
+    price = sp.array([1., 2., 3.])
+    exog = sp.array([[0.6, 0.3, 0.1],
+                     [0.2, 0.6, 0.2],
+                     [0.1, 0.3, 0.6]])
+    n = ne * nx
+    f = sp.zeros((n, m))
+    z = sp.zeros((nx, m), dtype=int)
+    P = sp.zeros((m, n, n))
+    for e in range(ne):
+        for i in range(nx):
+            for j in range(m):
+                z[i, j] = min(max(i - j, 0) + 2, nx - 1)
+                f[e * nx + i, j] = price[e] * j - j ** 2 / 4.
+                if j > i:
+                    f[e * nx + i, j] = -sp.inf
+                P[j, e * nx + i, sp.r_[0:ne] * nx + z[i, j]] = exog[e]
+    full = dp.Ddpsolve.from_transprob(P, reward=f, discount=0.9)
+    ref = full.newton()
+    v = sp.r_[0:n] / 5.
+    for transfunc in (z, sp.tile(z, (ne, 1))):
+        model = dp.Ddpsolve.from_kron(transfunc, exog, reward=f,
+                                      discount=0.9)
+        assert model.P is None
+        res = model.valmax(v)
+        assert sp.allclose(res[0], full.valmax(v)[0])
+        assert sp.array_equal(res[1], full.valmax(v)[1])
+        res = model.newton()
+        assert res[0] == 0
+        assert sp.array_equal(res[4], ref[4])
+        assert sp.allclose(res[3], ref[3])
+        assert sp.allclose(sparse.csr_matrix(res[5]).toarray(), ref[5])
+        res = model.funcit()
+        assert sp.array_equal(res[4], ref[4])
+        assert sp.allclose(res[3], ref[3], atol=1e-6)
+
+
+def test_multigrid():
+    for maxcap, dense in ((30, True), (60, False)):
+        f, P, r, p = _demddp05_loops(maxcap)
+        ref = dp.Ddpsolve.from_transprob(P, reward=f, discount=0.9).newton()
+        model = dp.Ddpsolve.from_transprob(P, reward=f, discount=0.9,
+                                           dense=dense)
+        for levels in (1, 2, 3, 4):
+            res = model.multigrid(levels=levels)
+            assert res[0] == 0
+            assert sp.array_equal(res[4], ref[4])
+            assert sp.allclose(res[3], ref[3], atol=1e-6)
+
+
+def test_modpolicy():
+    f, P, r, p = _demddp05_loops()
+    fg, g = _ddp01_loops(30)
+    models = [lambda: dp.Ddpsolve.from_transprob(P, reward=f, discount=0.9),
+              lambda: dp.Ddpsolve.from_transprob(P, reward=f, discount=0.9,
+                                                 dense=False),
+              lambda: dp.Ddpsolve(discount=0.9, reward=fg, g=g)]
+    for model in models:
+        ref = model().newton()
+        for k in (1, 5, 20):
+            res = model().modpolicy(k=k)
+            assert res[0] == 0
+            assert sp.array_equal(res[4], ref[4])
+            assert sp.allclose(res[3], ref[3], atol=1e-6)
+        ## No evaluation sweeps: function iteration
+        res = model().modpolicy(k=0)
+        fit = model().funcit()
+        assert res[:2] == fit[:2]
+        assert sp.allclose(res[3], fit[3])
+        assert sp.array_equal(res[4], fit[4])
+
+
+def test_ddpsweep():
+    f, P, r, p = _demddp05_loops()
+    m, n = P.shape[:2]
+    discounts = sp.array([0.9, 0.95, 0.85, 0.9])
+    rewards = sp.array([f, f, 2 * f, f - 0.1 * sp.r_[0:m]])
+    refs = [dp.Ddpsolve.from_transprob(P, reward=rewards[b],
+                                       discount=discounts[b]).newton()
+            for b in range(len(discounts))]
+    Pd = P.reshape((m * n, n))
+    for PP in (Pd, sparse.csr_matrix(Pd)):
+        for processes in (1, 2):
+            for method in ('newton', 'funcit'):
+                res = dp.ddpsweep(discounts, rewards, PP,
+                                  processes=processes, method=method)
+                for b, ref in enumerate(refs):
+                    assert res[0][b] == 0
+                    assert sp.array_equal(res[4][:, b], ref[4])
+                    assert sp.allclose(res[3][:, b], ref[3], atol=1e-6)
+
+
+def test_newton_krylov():
+    f, P, r, p = _demddp05_loops(40)
+    ref = dp.Ddpsolve.from_transprob(P, reward=f, discount=0.9).newton()
+    for solver in ('gmres', 'bicgstab'):
+        model = dp.Ddpsolve.from_transprob(P, reward=f, discount=0.9)
+        res = model.newton(solver=solver)
+        assert res[0] == 0
+        assert sp.array_equal(res[4], ref[4])
+        assert sp.allclose(res[3], ref[3], atol=1e-6)
+        assert sp.array_equal(model.valmax(res[3])[1], res[4])
+
+
+def test_newton_maxrank(monkeypatch):
+    factored = []
+    init = dp._PolicyFactor.__init__
+
+    def counted(self, model, x):
+        factored.append(1)
+        init(self, model, x)
+    monkeypatch.setattr(dp._PolicyFactor, '__init__', counted)
+    f, P, r, p = _demddp05_loops()
+    ## 100 has a tie in the optimal policy
+    fg, g = _ddp01_loops(60)
+    models = [lambda: dp.Ddpsolve.from_transprob(P, reward=f, discount=0.9),
+              lambda: dp.Ddpsolve.from_transprob(P, reward=f, discount=0.9,
+                                                 dense=False),
+              lambda: dp.Ddpsolve(discount=0.9, reward=fg, g=g)]
+    for model in models:
+        del factored[:]
+        ref = model().newton()
+        nref = len(factored)
+        del factored[:]
+        res = model().newton(maxrank=200)
+        assert res[0] == 0
+        assert res[1] == ref[1]
+        assert sp.array_equal(res[4], ref[4])
+        assert sp.allclose(res[3], ref[3])
+        assert nref > 1
+        assert len(factored) == 1
+
+
+def test_prioritized():
+    f, g = _ddp01_loops(200)
+    ref = dp.Ddpsolve(discount=0.9, reward=f, g=g).newton()
+    res = dp.Ddpsolve(discount=0.9, reward=f, g=g).prioritized()
+    assert res[0] == 0
+    assert sp.array_equal(res[4], ref[4])
+    assert sp.allclose(res[3], ref[3], atol=1e-6)
+    ## t counts backups of n states, as one step of funcit
+    res = dp.Ddpsolve(discount=0.9, reward=f, g=g).prioritized(batch=201)
+    assert res[0] == 0
+    assert res[1] <= dp.Ddpsolve(discount=0.9, reward=f, g=g).funcit()[1]
+    assert sp.array_equal(res[4], ref[4])
+    assert sp.allclose(res[3], ref[3], atol=1e-6)
+    f, P, r, p = _demddp05_loops()
+    ref = dp.Ddpsolve.from_transprob(P, reward=f, discount=0.9).newton()
+    model = dp.Ddpsolve.from_transprob(P, reward=f, discount=0.9, dense=False)
+    ## Mixing: more backups than funcit
+    res = model.prioritized(maxit=500)
+    assert res[0] == 0
+    assert sp.array_equal(res[4], ref[4])
+    assert sp.allclose(res[3], ref[3], atol=1e-6)
+
+
+def test_sccsolve():
+    f, g = _ddp01_loops(100)
+    ref = dp.Ddpsolve(discount=0.9, reward=f, g=g).newton()
+    res = dp.Ddpsolve(discount=0.9, reward=f, g=g).sccsolve()
+    ## Only single states: no subproblem is solved
+    assert res[:2] == (0, 0)
+    assert sp.array_equal(res[4], ref[4])
+    assert sp.allclose(res[3], ref[3])
+    ## One single absorbing state, and one larger component
+    f, P, r, p = _demddp05_loops()
+    P[:, 0] = 0
+    P[:, 0, 0] = 1
+    ref = dp.Ddpsolve.from_transprob(P, reward=f, discount=0.9).newton()
+    res = dp.Ddpsolve.from_transprob(P, reward=f, discount=0.9).sccsolve()
+    assert res[0] == 0
+    assert res[1] > 0
+    assert sp.array_equal(res[4], ref[4])
+    assert sp.allclose(res[3], ref[3])
+
+
+def test_warm_start():
+    f, P, r, p = _demddp05_loops()
+    model = dp.Ddpsolve.from_transprob(P, reward=f, discount=0.9)
+    assert model.funcit()[1] == model.funcit()[1]
+    model = dp.Ddpsolve.from_transprob(P, reward=f, discount=0.9,
+                                       warm_start=True)
+    ref = model.newton()
+    res = model.newton()
+    assert res[1] == 1
+    assert sp.array_equal(res[4], ref[4])
+
+
+def test_backsolve_scenarios(tmp_path):
+    model = _ddp06()
+    vterm = sp.column_stack([model.vterm, 2 * model.vterm,
+                             sp.r_[0:model.n] / 4.])
+    x, v, pstar = model.backsolve(vterm=vterm)
+    assert x.shape == (model.n, model.T, 3)
+    assert v.shape == (model.n, model.T + 1, 3)
+    for b in range(3):
+        xb, vb, pb = model.backsolve(vterm=vterm[:, b])
+        assert sp.array_equal(x[..., b], xb)
+        assert sp.allclose(v[..., b], vb)
+        assert sp.array_equal(pstar[b], pb)
+    xn, vn, pn = model.backsolve(vterm=vterm, store=None)
+    assert pn is None
+    assert sp.array_equal(xn, x)
+    with pytest.raises(ValueError):
+        model.backsolve(vterm=vterm, store='memmap',
+                        filename=str(tmp_path / "pstar.npy"))
+
+
+def test_tvbacksolve_vterm():
+    model = _ddp06()
+    x, v, pstar = model.backsolve()
+    stages = lambda t: (model.reward, model.P)
+    xt, vt = dp.tvbacksolve(stages, model.T, model.discount,
+                            vterm=model.vterm.reshape((-1, 1)))
+    assert sp.array_equal(xt, x)
+    assert sp.allclose(vt, v)
+
+
+def test_valmax_workers():
+    f, P, r, p = _demddp05_loops()
+    ref = dp.Ddpsolve.from_transprob(P, reward=f, discount=0.9).valmax(
+        sp.ones(f.shape[0]))
+    model = dp.Ddpsolve.from_transprob(P, reward=f, discount=0.9,
+                                       workers=2)
+    for workers in (2, 3):
+        model.workers = workers
+        v, x = model.valmax(sp.ones(f.shape[0]))
+        assert sp.allclose(v, ref[0])
+        assert sp.array_equal(x, ref[1])
+        assert model._pool[0] == workers
+    pool = model._pool[1]
+    model.close()
+    assert model._pool is None
+    assert all(not w.is_alive() for w in pool._pool)
+
+
+def _absorb():
+    """ Two states: action 0 moves to the absorbing state 1, action 1
+    stays in state 0 with reward 1 """
+    f = sp.array([[0., 1.], [0., 0.]])
+    P = sp.zeros((2, 2, 2))
+    P[0, :, 1] = 1
+    P[1, 0, 0] = 1
+    P[1, 1, 1] = 1
+    return f, P
+
+
+def test_warm_newton_after_funcit():
+    f, P = _absorb()
+    model = dp.Ddpsolve.from_transprob(P, reward=f, discount=0.9,
+                                       warm_start=True)
+    model.funcit()
+    f[1] = 100
+    model.setReward(f)
+    ref = dp.Ddpsolve.from_transprob(P, reward=f, discount=0.9).newton()
+    res = model.newton()
+    assert res[0] == 0
+    assert sp.array_equal(res[4], ref[4])
+    assert sp.allclose(res[3], ref[3])
+
+
+def test_warm_newton_after_setdiscount():
+    f, P = _absorb()
+    f[1] = 1.08
+    model = dp.Ddpsolve.from_transprob(P, reward=f, discount=0.9,
+                                       warm_start=True)
+    model.newton()
+    model.setDiscount(0.95)
+    ref = dp.Ddpsolve.from_transprob(P, reward=f, discount=0.95).newton()
+    res = model.newton()
+    assert res[0] == 0
+    assert sp.array_equal(res[4], ref[4])
+    assert sp.allclose(res[3], ref[3])
+
+
+def test_funcit_anderson():
+    f, P, r, p = _demddp05_loops()
+    ref = dp.Ddpsolve.from_transprob(P, reward=f, discount=0.9).newton()
+    plain = dp.Ddpsolve.from_transprob(P, reward=f, discount=0.9).funcit()
+    for depth in (1, 5):
+        model = dp.Ddpsolve.from_transprob(P, reward=f, discount=0.9)
+        res = model.funcit(anderson=depth)
+        assert res[0] == 0
+        assert res[1] <= plain[1]
+        assert sp.array_equal(res[4], ref[4])
+        assert sp.allclose(res[3], ref[3], atol=1e-6)